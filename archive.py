@@ -0,0 +1,365 @@
+import argparse
+import gzip
+import hashlib
+import json
+import re
+import threading
+from os import listdir, remove
+from os.path import isfile, join, isdir
+
+import arrow
+
+try:
+    import zstandard
+except ImportError:
+    # Only needed for "archive_compression": "zstd"
+    zstandard = None
+
+# Functions and constants shared by downloader.py and sender.py for the local archive of
+# fitbit data.
+
+FITBIT_API_URL = "https://api.fitbit.com"
+TCX_FILE_URL = FITBIT_API_URL + "/1/user/-/activities/{}.tcx"
+# Per minute activity series, one file per resource.
+# https://dev.fitbit.com/build/reference/web-api/intraday/get-activity-intraday-by-date/
+INTRADAY_RESOURCES = ["steps", "calories", "distance", "floors", "elevation"]
+INTRADAY_URL = FITBIT_API_URL + "/1/user/-/activities/{}/date/{{}}/1d/1min.json"
+
+
+def get_intraday_file_name(resource):
+    return f"intra-day-{resource}-series.json"
+
+
+FILE_URL_MAPPING = {
+    "intra-day-heart-rate-series.json": FITBIT_API_URL
+    + "/1/user/-/activities/heart/date/{}/1d/1sec.json",
+    "activities.json": FITBIT_API_URL + "/1/user/-/activities/date/{}.json",
+    "sleep.json": FITBIT_API_URL + "/1.2/user/-/sleep/date/{}.json",
+}
+# Heart rate samples between two times (HH:mm) of a day, polled by daemon.py.
+# https://dev.fitbit.com/build/reference/web-api/intraday/get-heartrate-intraday-by-date/
+HEART_RATE_WINDOW_URL = (
+    FITBIT_API_URL + "/1/user/-/activities/heart/date/{}/1d/1sec/time/{}/{}.json"
+)
+# Sleep logs of up to 100 days in one request, split in to the day's sleep.json by the
+# downloader.
+# https://dev.fitbit.com/build/reference/web-api/sleep/get-sleep-log-by-date-range/
+SLEEP_RANGE_URL = FITBIT_API_URL + "/1.2/user/-/sleep/date/{}/{}.json"
+SLEEP_RANGE_MAX_DAYS = 100
+
+FILE_URL_MAPPING.update(
+    {
+        get_intraday_file_name(resource): INTRADAY_URL.format(resource)
+        for resource in INTRADAY_RESOURCES
+    }
+)
+
+ARCHIVAL_FILE_LISTING = FILE_URL_MAPPING.keys()
+
+# --only for both scripts, the files each data type is downloaded as. "activity"
+# includes the tcx files.
+DATA_TYPE_FILES = {
+    "heart": ["intra-day-heart-rate-series.json"],
+    "sleep": ["sleep.json"],
+    "activity": ["activities.json"],
+    "intraday": [get_intraday_file_name(resource) for resource in INTRADAY_RESOURCES],
+}
+DATA_TYPES = list(DATA_TYPE_FILES)
+
+MANIFEST_FILE_NAME = "manifest.jsonl"
+
+# user_id of the single user of a config.json without "users", also the user of rows
+# loaded before user_id existed.
+DEFAULT_USER_ID = "default"
+# Used as a folder name and in the user_id columns.
+USER_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,32}")
+
+
+def get_users(config):
+    # "users" in config.json is a list of {"user_id": "alice", "fitbit_token": "..."},
+    # each user is archived in a sub folder of the archive folder named after the
+    # user_id. Without it "fitbit_token" is the default user, archived in the archive
+    # folder itself.
+    archive_folder = config["fitbit_data_archival_folder"]
+    if "users" not in config:
+        return [
+            {
+                "user_id": DEFAULT_USER_ID,
+                "fitbit_token": config.get("fitbit_token"),
+                "archive_folder": archive_folder,
+            }
+        ]
+    users = []
+    for user in config["users"]:
+        assert USER_ID_PATTERN.fullmatch(
+            user["user_id"]
+        ), f"invalid user_id {user['user_id']}"
+        users.append(dict(user, archive_folder=join(archive_folder, user["user_id"])))
+    return users
+
+
+def select_users(users, user_ids):
+    # --users, None selects every user.
+    if user_ids is None:
+        return users
+    unknown_user_ids = user_ids - {user["user_id"] for user in users}
+    assert (
+        len(unknown_user_ids) == 0
+    ), f"unknown users {','.join(sorted(unknown_user_ids))}"
+    return [user for user in users if user["user_id"] in user_ids]
+
+
+def open_zstd(file_path, mode):
+    if zstandard is None:
+        raise RuntimeError("zstd compressed archives need the zstandard package")
+    return zstandard.open(file_path, mode)
+
+
+# "archive_compression" in config.json -> suffix added to the file name in the archive
+# and how to open it.
+ARCHIVE_COMPRESSIONS = {
+    None: ("", open),
+    "gzip": (".gz", gzip.open),
+    "zstd": (".zst", open_zstd),
+}
+
+
+def get_stored_file_name(file_name, compression):
+    return file_name + ARCHIVE_COMPRESSIONS[compression][0]
+
+
+def open_for_archiving(file_path, compression):
+    return ARCHIVE_COMPRESSIONS[compression][1](file_path, "wb")
+
+
+def get_logical_file_name(stored_file_name):
+    for suffix, _ in ARCHIVE_COMPRESSIONS.values():
+        if suffix != "" and stored_file_name.endswith(suffix):
+            return stored_file_name[: -len(suffix)]
+    return stored_file_name
+
+
+def remove_other_stored_files(file_path, compression):
+    # Copies of the file stored with another compression, from before
+    # archive_compression changed.
+    # open_archived_file would read them instead of the file that was just archived.
+    for other_compression, (suffix, _) in ARCHIVE_COMPRESSIONS.items():
+        if other_compression != compression and isfile(file_path + suffix):
+            remove(file_path + suffix)
+
+
+def open_archived_file(file_path):
+    # file_path is the name the file was downloaded as, it may be stored with any of the
+    # compressions.
+    # Opened in binary mode, json.load and ElementTree both read bytes.
+    for suffix, opener in ARCHIVE_COMPRESSIONS.values():
+        if isfile(file_path + suffix):
+            return opener(file_path + suffix, "rb")
+    raise FileNotFoundError(file_path)
+
+
+def get_file_type(file_name):
+    # Label for metrics, every activity's tcx file is one file type.
+    if file_name.endswith(".xml"):
+        return "tcx"
+    return file_name.split(".")[0]
+
+
+def get_data_type(file_name):
+    if file_name.endswith(".xml"):
+        return "activity"
+    return next(
+        data_type
+        for data_type, file_names in DATA_TYPE_FILES.items()
+        if file_name in file_names
+    )
+
+
+def parse_data_types(value):
+    data_types = value.split(",")
+    for data_type in data_types:
+        if data_type not in DATA_TYPE_FILES:
+            raise argparse.ArgumentTypeError(
+                f"unknown data type {data_type}, expected a comma separated list of {','.join(DATA_TYPES)}"
+            )
+    return set(data_types)
+
+
+def parse_date(value):
+    # Day folder name, folders compare as strings.
+    return arrow.get(value).format("YYYY-MM-DD")
+
+
+def add_selection_arguments(parser):
+    # Shared by downloader.py and sender.py, without them every day since start_date and
+    # every data type is walked.
+    parser.add_argument(
+        "--from",
+        dest="from_date",
+        type=parse_date,
+        help="first day (YYYY-MM-DD) to process, start_date in config.json by default",
+    )
+    parser.add_argument(
+        "--to",
+        dest="to_date",
+        type=parse_date,
+        help="last day (YYYY-MM-DD) to process, inclusive",
+    )
+    parser.add_argument(
+        "--only",
+        type=parse_data_types,
+        default=set(DATA_TYPES),
+        help=f"comma separated data types to process, any of {','.join(DATA_TYPES)}",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="process the days again even if they are already downloaded or loaded",
+    )
+    parser.add_argument(
+        "--users",
+        dest="user_ids",
+        type=lambda value: set(value.split(",")),
+        help="comma separated user_ids from config.json to process, every user by default",
+    )
+
+
+def is_in_date_range(folder, from_date, to_date):
+    return (from_date is None or folder >= from_date) and (
+        to_date is None or folder <= to_date
+    )
+
+
+def get_archived_files(folder_path):
+    if isdir(folder_path):
+        return [f for f in listdir(folder_path) if isfile(join(folder_path, f))]
+    else:
+        return None
+
+
+def get_activity_log_ids(activity_obj):
+    return [activity["logId"] for activity in activity_obj["activities"]]
+
+
+def get_activity_log_file_names(date_string_folder_path):
+    activity_filename = join(date_string_folder_path, "activities.json")
+    with open_archived_file(activity_filename) as activity_file_handler:
+        activity_logIds = get_activity_log_ids(json.load(activity_file_handler))
+    return [(str(activity_logId) + ".xml") for activity_logId in activity_logIds]
+
+
+def content_checksum(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+def file_checksum(file_path):
+    # Of the uncompressed contents, the same file has the same checksum whatever it is
+    # stored as.
+    sha1 = hashlib.sha1()
+    size = 0
+    with open_archived_file(file_path) as file_handler:
+        for block in iter(lambda: file_handler.read(1 << 20), b""):
+            sha1.update(block)
+            size += len(block)
+    return size, sha1.hexdigest()
+
+
+class Manifest:
+    # Append only JSON lines file in the archive folder, one line per downloaded (or
+    # failed) file:
+    # {"folder": "2021-04-10", "file": "activities.json", "stored_as": "activities.json.gz", "size": 1234, "sha1": "..", "status": 200, "fetched_at": "..", "tcx": [..]}
+    # The last line for a file wins, unless it is a failed download of a file that is
+    # already archived, the file on disk is still good. "tcx" is only set for
+    # activities.json and lists the tcx files the day needs, so neither script has to
+    # list folders or open activities.json to find out what is missing.
+    # size and sha1 are of the uncompressed file.
+    def __init__(self, archive_folder):
+        self.archive_folder = archive_folder
+        self.path = join(archive_folder, MANIFEST_FILE_NAME)
+        self.folders = {}
+        self.lock = threading.Lock()
+        if isfile(self.path):
+            self.load()
+        elif isdir(archive_folder):
+            self.bootstrap()
+
+    def load(self):
+        with open(self.path) as manifest_file_handler:
+            for line in manifest_file_handler:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Partially written last line from an interrupted run.
+                    continue
+                self.add_entry(entry)
+
+    def add_entry(self, entry):
+        files = self.folders.setdefault(entry["folder"], {})
+        previous_entry = files.get(entry["file"])
+        if (
+            entry["status"] != 200
+            and previous_entry is not None
+            and previous_entry["status"] == 200
+        ):
+            return
+        files[entry["file"]] = entry
+
+    def bootstrap(self):
+        # Archives downloaded before the manifest existed are scanned once.
+        for folder in sorted(listdir(self.archive_folder)):
+            folder_path = join(self.archive_folder, folder)
+            if not isdir(folder_path):
+                continue
+            for stored_file_name in get_archived_files(folder_path):
+                if stored_file_name.endswith("_bk"):
+                    continue
+                file_name = get_logical_file_name(stored_file_name)
+                size, sha1 = file_checksum(join(folder_path, file_name))
+                tcx_files = None
+                if file_name == "activities.json":
+                    tcx_files = get_activity_log_file_names(folder_path)
+                self.record(
+                    folder, file_name, size, sha1, 200, tcx_files, stored_file_name
+                )
+
+    def record(
+        self, folder, file_name, size, sha1, status, tcx_files=None, stored_as=None
+    ):
+        entry = {
+            "folder": folder,
+            "file": file_name,
+            "stored_as": stored_as,
+            "size": size,
+            "sha1": sha1,
+            "status": status,
+            "fetched_at": arrow.utcnow().isoformat(),
+        }
+        if tcx_files is not None:
+            entry["tcx"] = tcx_files
+        with self.lock:
+            with open(self.path, "a") as manifest_file_handler:
+                manifest_file_handler.write(json.dumps(entry) + "\n")
+            self.add_entry(entry)
+
+    def get_files(self, folder):
+        # Only files that were downloaded successfully.
+        return {
+            file_name: entry
+            for file_name, entry in self.folders.get(folder, {}).items()
+            if entry["status"] == 200
+        }
+
+    def get_expected_files(self, folder):
+        files = self.get_files(folder)
+        expected_files = list(ARCHIVAL_FILE_LISTING)
+        if "activities.json" in files:
+            expected_files.extend(files["activities.json"].get("tcx", []))
+        return expected_files
+
+    def get_missing_files(self, folder):
+        files = self.get_files(folder)
+        return [
+            file_name
+            for file_name in self.get_expected_files(folder)
+            if file_name not in files
+        ]
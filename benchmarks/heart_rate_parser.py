@@ -0,0 +1,46 @@
+import sys
+import tempfile
+import timeit
+from os.path import abspath, dirname
+
+# Needs to run from a folder with config.json, sender.py reads it on import.
+# python benchmarks/heart_rate_parser.py [day_folder ...]
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from loader import object_to_row
+from benchmarks.synthetic import write_heart_rate_day
+from sender import parse_heart_rate_data, parse_heart_rate_columns
+
+REPEAT = 3
+
+
+def assert_same_rows(folder_path):
+    expected_rows = {}
+    for parsed_object in parse_heart_rate_data(folder_path):
+        expected_rows.setdefault(parsed_object.__tablename__, []).append(
+            object_to_row(parsed_object)
+        )
+    for batch in parse_heart_rate_columns(folder_path):
+        assert list(batch.rows()) == expected_rows[batch.table_name], batch.table_name
+
+
+def benchmark(folder_path):
+    assert_same_rows(folder_path)
+    for parser in [parse_heart_rate_data, parse_heart_rate_columns]:
+        seconds = min(
+            timeit.repeat(lambda: list(parser(folder_path)), number=1, repeat=REPEAT)
+        )
+        print(f"{folder_path} {parser.__name__}: {seconds:.3f}s")
+
+
+def main():
+    folder_paths = sys.argv[1:]
+    if len(folder_paths) == 0:
+        archive_folder = tempfile.mkdtemp()
+        folder_paths = [write_heart_rate_day(archive_folder, "2021-04-10")]
+    for folder_path in folder_paths:
+        benchmark(folder_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import listdir
+from os.path import abspath, dirname, isdir, join
+
+# Stand-in for the fitbit web api to load test downloader.py and daemon.py without a
+# token's hourly quota.
+# python benchmarks/mock_fitbit.py --port 8080 --rate-limit 150 --latency-ms 200 --error-rate 0.02
+# and "fitbit_api_url": "http://127.0.0.1:8080" in config.json.
+# Any bearer token is accepted, each has its own quota.
+# Payloads are synthetic days from benchmarks/synthetic.py, or the files of an archive
+# folder with --archive.
+REPOSITORY_FOLDER = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, REPOSITORY_FOLDER)
+
+from archive import (
+    FITBIT_API_URL,
+    TCX_FILE_URL,
+    FILE_URL_MAPPING,
+    HEART_RATE_WINDOW_URL,
+    SLEEP_RANGE_URL,
+    INTRADAY_RESOURCES,
+    get_intraday_file_name,
+    get_logical_file_name,
+    open_archived_file,
+)
+from benchmarks.synthetic import (
+    activities_day,
+    get_activity_start,
+    get_log_ids,
+    heart_rate_series,
+    intraday_series,
+    sleep_day,
+    tcx_file,
+)
+from metrics import Metrics, add_metrics_arguments, start_metrics, finish_metrics
+
+metrics = Metrics("fitbit_mock")
+
+INTRADAY_FILE_RESOURCES = {
+    get_intraday_file_name(resource): resource for resource in INTRADAY_RESOURCES
+}
+TRANSIENT_ERRORS = [500, 502, 503, 504]
+
+
+def url_pattern(url):
+    # The path of an archive.py url template, each {} matches one path segment.
+    path = url[len(FITBIT_API_URL) :]
+    return re.compile(
+        "^" + "([^/]+)".join(re.escape(part) for part in path.split("{}")) + "$"
+    )
+
+
+def check_date(value):
+    # Raises ValueError for anything but YYYY-MM-DD, answered with a 400 like the api
+    # does.
+    datetime.strptime(value, "%Y-%m-%d")
+    return value
+
+
+class RateLimits:
+    # Fixed hourly windows per token like fitbit's, the quota resets at the top of the
+    # window for every token.
+    # https://dev.fitbit.com/build/reference/web-api/developer-guide/application-design/#Rate-Limits
+    def __init__(self, limit, window_seconds):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def take(self, token):
+        # (allowed, remaining, seconds until the reset)
+        now = time.time()
+        window = int(now // self.window_seconds)
+        with self.lock:
+            token_window, count = self.requests.get(token, (window, 0))
+            if token_window != window:
+                count = 0
+            count += 1
+            self.requests[token] = (window, count)
+        reset_seconds = int((window + 1) * self.window_seconds - now)
+        return count <= self.limit, max(0, self.limit - count), reset_seconds
+
+
+class MockFitbit:
+    def __init__(self, arguments):
+        self.arguments = arguments
+        self.rate_limits = RateLimits(arguments.rate_limit, arguments.rate_limit_window)
+        self.rng = random.Random(arguments.seed)
+        self.rng_lock = threading.Lock()
+        self.tcx_files = self.index_tcx_files()
+        self.routes = [
+            (url_pattern(url), "file", file_name)
+            for file_name, url in FILE_URL_MAPPING.items()
+        ] + [
+            (url_pattern(TCX_FILE_URL), "tcx", None),
+            (url_pattern(HEART_RATE_WINDOW_URL), "heart_rate_window", None),
+            (url_pattern(SLEEP_RANGE_URL), "sleep_range", None),
+        ]
+        # Heart rate days are slow to generate and several MB, repeated requests for a
+        # day are served from memory.
+        self.get_payload = lru_cache(maxsize=arguments.cache_size)(self.build_payload)
+
+    def random(self):
+        with self.rng_lock:
+            return self.rng.random()
+
+    def index_tcx_files(self):
+        # Log ids of recorded activities don't say which day they are archived in.
+        tcx_files = {}
+        archive_folder = self.arguments.archive
+        if archive_folder is None:
+            return tcx_files
+        for folder in listdir(archive_folder):
+            if not isdir(join(archive_folder, folder)):
+                continue
+            for stored_file_name in listdir(join(archive_folder, folder)):
+                file_name = get_logical_file_name(stored_file_name)
+                if file_name.endswith(".xml"):
+                    tcx_files[file_name[: -len(".xml")]] = join(
+                        archive_folder, folder, file_name
+                    )
+        return tcx_files
+
+    def day_rng(self, date):
+        # Every request for a day gets the same payload, whatever order they come in.
+        return random.Random(f"{self.arguments.seed}-{date}")
+
+    def read_recorded(self, file_path):
+        with open_archived_file(file_path) as file_handler:
+            metrics.increment("payloads", source="archive")
+            return file_handler.read()
+
+    def read_day_file(self, file_name, date):
+        if self.arguments.archive is not None:
+            try:
+                return json.loads(
+                    self.read_recorded(join(self.arguments.archive, date, file_name))
+                )
+            except FileNotFoundError:
+                pass
+        metrics.increment("payloads", source="synthetic")
+        rng = self.day_rng(date)
+        if file_name == "intra-day-heart-rate-series.json":
+            return heart_rate_series(date, rng)
+        if file_name == "sleep.json":
+            return sleep_day(date, rng, self.arguments.sleep_type)
+        if file_name == "activities.json":
+            log_ids = get_log_ids(date, self.arguments.activities)
+            return activities_day(date, log_ids, self.arguments.trackpoints, rng)
+        return intraday_series(INTRADAY_FILE_RESOURCES[file_name], date, rng)
+
+    def build_payload(self, route, values):
+        # (content type, body) of a matched route.
+        if route == "tcx":
+            (log_id,) = values
+            if log_id in self.tcx_files:
+                return "application/vnd.garmin.tcx+xml", self.read_recorded(
+                    self.tcx_files[log_id]
+                )
+            # Synthetic log ids are the day followed by the activity's index.
+            date = datetime.strptime(log_id[:-2], "%Y%m%d").strftime("%Y-%m-%d")
+            metrics.increment("payloads", source="synthetic")
+            start = get_activity_start(date, int(log_id[-2:]))
+            tcx = tcx_file(start, self.arguments.trackpoints, self.day_rng(log_id))
+            return "application/vnd.garmin.tcx+xml", tcx.encode()
+        if route == "heart_rate_window":
+            date, start, end = values
+            series_obj = self.read_day_file(
+                "intra-day-heart-rate-series.json", check_date(date)
+            )
+            intraday = series_obj["activities-heart-intraday"]
+            # Times are compared as text, HH:mm sorts before every HH:mm:ss of the
+            # minute.
+            series_obj["activities-heart-intraday"] = dict(
+                intraday,
+                dataset=[
+                    sample
+                    for sample in intraday["dataset"]
+                    if start <= sample["time"] < end + ":60"
+                ],
+            )
+            return "application/json", json.dumps(series_obj).encode()
+        if route == "sleep_range":
+            start, end = [datetime.strptime(value, "%Y-%m-%d") for value in values]
+            sleep_logs = []
+            for day in range(start.toordinal(), end.toordinal() + 1):
+                date = datetime.fromordinal(day).strftime("%Y-%m-%d")
+                sleep_logs.extend(self.read_day_file("sleep.json", date)["sleep"])
+            return "application/json", json.dumps({"sleep": sleep_logs}).encode()
+        (date,) = values
+        return (
+            "application/json",
+            json.dumps(self.read_day_file(route, check_date(date))).encode(),
+        )
+
+    def match(self, path):
+        for pattern, route, file_name in self.routes:
+            match = pattern.match(path)
+            if match is not None:
+                return file_name or route, match.groups()
+        return "unknown", None
+
+
+def make_handler(mock):
+    arguments = mock.arguments
+
+    class FitbitHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def respond(
+            self, status, body=b"", content_type="application/json", headers=()
+        ):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def respond_error(self, status, error_type, message, headers=()):
+            body = json.dumps(
+                {
+                    "errors": [{"errorType": error_type, "message": message}],
+                    "success": False,
+                }
+            ).encode()
+            self.respond(status, body, headers=headers)
+
+        def do_GET(self):
+            start = time.perf_counter()
+            route, status = self.handle_request()
+            metrics.increment("requests", route=route, status=status)
+            metrics.observe("response", time.perf_counter() - start, route=route)
+
+        def handle_request(self):
+            # (route, status) of the response, for the metrics.
+            route, values = mock.match(self.path.split("?")[0])
+            authorization = self.headers.get("Authorization", "")
+            if not authorization.startswith("Bearer "):
+                self.respond_error(401, "invalid_token", "Access token missing")
+                return route, 401
+            if arguments.latency_ms > 0:
+                time.sleep(arguments.latency_ms / 1000 * random.uniform(0.5, 1.5))
+            allowed, remaining, reset_seconds = mock.rate_limits.take(authorization)
+            headers = [
+                ("Fitbit-Rate-Limit-Limit", str(arguments.rate_limit)),
+                ("Fitbit-Rate-Limit-Remaining", str(remaining)),
+                ("Fitbit-Rate-Limit-Reset", str(reset_seconds)),
+            ]
+            if not allowed:
+                headers.append(("Retry-After", str(reset_seconds)))
+                self.respond_error(429, "system", "Too Many Requests", headers)
+                return route, 429
+            if mock.random() < arguments.error_rate:
+                status = random.choice(TRANSIENT_ERRORS)
+                self.respond_error(status, "system", "Transient error", headers)
+                return route, status
+            if values is None:
+                self.respond_error(
+                    404, "not_found", f"No route for {self.path}", headers
+                )
+                return route, 404
+            try:
+                content_type, body = mock.get_payload(route, values)
+            except ValueError:
+                self.respond_error(
+                    400, "validation", f"Invalid date in {self.path}", headers
+                )
+                return route, 400
+            self.respond(200, body, content_type, headers)
+            metrics.increment("response_bytes", len(body), route=route)
+            return route, 200
+
+        def log_message(self, *arguments):
+            if mock.arguments.verbose:
+                super().log_message(*arguments)
+
+    return FitbitHandler
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Serves the fitbit api urls downloader.py fetches from synthetic or archived payloads"
+    )
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--archive",
+        help="a user's archive folder, its files are served for the days in it and synthetic ones for the rest",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=int,
+        default=150,
+        help="requests per token and window before answering 429",
+    )
+    parser.add_argument(
+        "--rate-limit-window",
+        type=int,
+        default=3600,
+        help="seconds the rate limit quota lasts for",
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=int,
+        default=0,
+        help="average delay of a response, +/- 50%%",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="fraction of requests answered with a transient 5xx",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--activities", type=int, default=1, help="synthetic activities per day"
+    )
+    parser.add_argument(
+        "--trackpoints", type=int, default=3600, help="per synthetic activity"
+    )
+    parser.add_argument(
+        "--sleep-type",
+        choices=["classic", "stages"],
+        default="stages",
+        help="of the synthetic sleep logs",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=64,
+        help="payloads kept in memory",
+    )
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    add_metrics_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    start_metrics(metrics, arguments)
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", arguments.port), make_handler(MockFitbit(arguments))
+    )
+    print(f"Serving the fitbit api on http://127.0.0.1:{arguments.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    finish_metrics(metrics, arguments)
+
+
+if __name__ == "__main__":
+    main()
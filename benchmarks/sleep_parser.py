@@ -0,0 +1,69 @@
+import json
+import sys
+import tempfile
+import timeit
+from os.path import abspath, dirname, join
+
+# Needs to run from a folder with config.json, sender.py reads it on import.
+# python benchmarks/sleep_parser.py [day_folder ...]
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from loader import object_to_row
+from benchmarks.synthetic import write_sleep_day
+from models import SleepClassicInfo, SleepLevel, SleepStage, SleepStagesInfo
+from sender import (
+    expand_sleep_levels,
+    parse_classic_sleep_info,
+    parse_stages_sleep_info,
+)
+
+REPEAT = 5
+PARSERS = {
+    "classic": (
+        parse_classic_sleep_info,
+        lambda sleep_info: expand_sleep_levels(
+            sleep_info, SleepClassicInfo, SleepLevel
+        ),
+    ),
+    "stages": (
+        parse_stages_sleep_info,
+        lambda sleep_info: expand_sleep_levels(sleep_info, SleepStagesInfo, SleepStage),
+    ),
+}
+
+
+def benchmark(folder_path):
+    with open(join(folder_path, "sleep.json")) as sleep_file_handler:
+        sleep_obj = json.load(sleep_file_handler)
+    for sleep_info in sleep_obj["sleep"]:
+        reference_parser, columnar_parser = PARSERS[sleep_info["type"]]
+        expected_rows = sorted(
+            object_to_row(parsed_object)
+            for parsed_object in reference_parser(sleep_info)
+        )
+        assert list(columnar_parser(sleep_info).rows()) == expected_rows
+        for name, parser in [
+            ("arrow", reference_parser),
+            ("columnar", columnar_parser),
+        ]:
+            seconds = min(
+                timeit.repeat(lambda: parser(sleep_info), number=1, repeat=REPEAT)
+            )
+            print(
+                f"{folder_path} {sleep_info['type']} ({len(expected_rows)} rows) {name}: {seconds * 1000:.2f}ms"
+            )
+
+
+def main():
+    folder_paths = sys.argv[1:]
+    if len(folder_paths) == 0:
+        folder_paths = [
+            write_sleep_day(tempfile.mkdtemp(), "2021-04-10", sleep_type)
+            for sleep_type in ["classic", "stages"]
+        ]
+    for folder_path in folder_paths:
+        benchmark(folder_path)
+
+
+if __name__ == "__main__":
+    main()
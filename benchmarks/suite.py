@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from multiprocessing import get_context
+from os.path import abspath, dirname, join
+
+# Needs to run from a folder with config.json, sender.py reads it on import.
+# python benchmarks/suite.py [--days N] [--ingest] [--output results.json]
+# --ingest loads the synthetic archive with sender.py in to the database from
+# config.json, e.g. a local container:
+# docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=password timescale/timescaledb-postgis:latest-pg12
+# The image needs postgis for the geometry columns, it is the one docker-compose.yml
+# runs.
+REPOSITORY_FOLDER = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, REPOSITORY_FOLDER)
+
+from benchmarks.synthetic import write_archive
+
+PARSERS = [
+    "parse_heart_rate_columns",
+    "parse_sleep_zone_info",
+    "parse_activity_info",
+    "parse_intraday_activity_columns",
+    "iter_folder_batches",
+]
+
+
+def max_rss_mib(usage):
+    # ru_maxrss is in KiB on linux and in bytes on macOS.
+    if sys.platform == "darwin":
+        return usage.ru_maxrss / 2**20
+    return usage.ru_maxrss / 2**10
+
+
+def run_parser(parser_name, folder_paths):
+    # Runs in a fresh process, so the peak RSS is of this parser alone.
+    import sender
+
+    parser = getattr(sender, parser_name)
+    baseline_rss = max_rss_mib(resource.getrusage(resource.RUSAGE_SELF))
+    rows = 0
+    start = time.perf_counter()
+    for folder_path in folder_paths:
+        for batch in parser(folder_path):
+            rows += len(batch)
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "rows": rows,
+        "rows_per_second": rows / seconds,
+        "baseline_rss_mib": baseline_rss,
+        "peak_rss_mib": max_rss_mib(resource.getrusage(resource.RUSAGE_SELF)),
+    }
+
+
+def benchmark_parsers(folder_paths):
+    results = {}
+    for parser_name in PARSERS:
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=get_context("spawn")
+        ) as executor:
+            results[parser_name] = executor.submit(
+                run_parser, parser_name, folder_paths
+            ).result()
+        print(
+            f"{parser_name}: {results[parser_name]['rows']} rows in {results[parser_name]['seconds']:.2f}s ({results[parser_name]['rows_per_second']:.0f} rows/sec), peak RSS {results[parser_name]['peak_rss_mib']:.0f}MiB"
+        )
+    return results
+
+
+def read_rows_loaded(metrics_path):
+    # Sum of sender.py's rows_loaded counters over every table.
+    rows = 0
+    with open(metrics_path) as metrics_file_handler:
+        for line in metrics_file_handler:
+            if line.startswith("fitbit_sender_rows_loaded_total"):
+                rows += int(float(line.split()[-1]))
+    return rows
+
+
+def benchmark_ingest(archive_folder, start_date, days, sender_arguments):
+    # sender.py runs in its own folder with a copy of config.json that points at the
+    # synthetic archive.
+    # The days are loaded with --force, their rows are deleted from the database and
+    # loaded again on every run, and rows/sec is of the rows sender.py reports as
+    # loaded.
+    with open("config.json") as config_file_handler:
+        config = json.load(config_file_handler)
+    config["fitbit_data_archival_folder"] = archive_folder
+    config["start_date"] = start_date
+    working_folder = tempfile.mkdtemp()
+    with open(join(working_folder, "config.json"), "w") as config_file_handler:
+        json.dump(config, config_file_handler)
+    log_path = join(working_folder, "sender.log")
+    metrics_path = join(working_folder, "sender.prom")
+    end_date = datetime.strptime(start_date, "%Y-%m-%d") + timedelta(days=days - 1)
+    sender_arguments = sender_arguments + [
+        "--force",
+        "--from",
+        start_date,
+        "--to",
+        end_date.strftime("%Y-%m-%d"),
+        "--metrics-file",
+        metrics_path,
+    ]
+    start = time.perf_counter()
+    with open(log_path, "w") as log_file_handler:
+        process = subprocess.Popen(
+            [sys.executable, join(REPOSITORY_FOLDER, "sender.py")] + sender_arguments,
+            cwd=working_folder,
+            stdout=log_file_handler,
+            stderr=subprocess.STDOUT,
+        )
+        _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    assert os.waitstatus_to_exitcode(status) == 0, f"sender.py failed, see {log_path}"
+    rows = read_rows_loaded(metrics_path)
+    result = {
+        "arguments": sender_arguments,
+        "seconds": seconds,
+        "rows": rows,
+        "rows_per_second": rows / seconds,
+        "peak_rss_mib": max_rss_mib(usage),
+        "log": log_path,
+    }
+    print(
+        f"ingest {' '.join(sender_arguments)}: {rows} rows in {seconds:.2f}s ({result['rows_per_second']:.0f} rows/sec), peak RSS {result['peak_rss_mib']:.0f}MiB"
+    )
+    return result
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPOSITORY_FOLDER,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Time the sender's parsers and a full ingest on a synthetic archive"
+    )
+    parser.add_argument("--days", type=int, default=3)
+    parser.add_argument("--start-date", default="2021-04-10")
+    parser.add_argument("--activities", type=int, default=1, help="activities per day")
+    parser.add_argument(
+        "--trackpoints", type=int, default=3600, help="trackpoints per activity"
+    )
+    parser.add_argument(
+        "--archive",
+        help="archive folder to write the synthetic days to, a temporary folder by default",
+    )
+    parser.add_argument(
+        "--ingest",
+        action="store_true",
+        help="also load the archive with sender.py --force in to the database from config.json, it deletes what is loaded for those days",
+    )
+    parser.add_argument(
+        "--sender-arguments",
+        default="",
+        help='passed on to sender.py for --ingest, e.g. "--workers 4"',
+    )
+    parser.add_argument("--output", default="benchmark_results.json")
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    archive_folder = abspath(arguments.archive or tempfile.mkdtemp())
+    start = time.perf_counter()
+    folder_paths = write_archive(
+        archive_folder,
+        arguments.start_date,
+        arguments.days,
+        arguments.activities,
+        arguments.trackpoints,
+    )
+    print(
+        f"{len(folder_paths)} days written to {archive_folder} in {time.perf_counter() - start:.1f}s"
+    )
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "archive": {
+            "days": arguments.days,
+            "start_date": arguments.start_date,
+            "activities": arguments.activities,
+            "trackpoints": arguments.trackpoints,
+        },
+        "parsers": benchmark_parsers(folder_paths),
+    }
+    if arguments.ingest:
+        results["ingest"] = benchmark_ingest(
+            archive_folder,
+            arguments.start_date,
+            arguments.days,
+            shlex.split(arguments.sender_arguments),
+        )
+    with open(arguments.output, "w") as output_file_handler:
+        json.dump(results, output_file_handler, indent=4)
+    print(f"Results saved to {arguments.output}")
+
+
+if __name__ == "__main__":
+    main()
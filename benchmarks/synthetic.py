@@ -0,0 +1,307 @@
+import json
+import random
+from datetime import datetime, timedelta
+from os import makedirs
+from os.path import join
+
+# Synthetic day folders in the same layout `downloader.ensure_download` writes to the
+# archive.
+
+HEART_RATE_ZONES = [
+    ("Out of Range", 30, 99),
+    ("Fat Burn", 99, 138),
+    ("Cardio", 138, 168),
+    ("Peak", 168, 220),
+]
+
+
+def heart_rate_series(date, rng, samples=86400):
+    dataset = []
+    heart_rate = 60
+    for second in range(samples):
+        heart_rate = min(190, max(45, heart_rate + rng.randint(-2, 2)))
+        dataset.append(
+            {
+                "time": f"{second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}",
+                "value": heart_rate,
+            }
+        )
+    return {
+        "activities-heart": [
+            {
+                "dateTime": date,
+                "value": {
+                    "customHeartRateZones": [],
+                    "heartRateZones": [
+                        {
+                            "name": name,
+                            "min": minimum,
+                            "max": maximum,
+                            "minutes": rng.randint(0, 600),
+                            "caloriesOut": rng.uniform(0, 2000),
+                        }
+                        for name, minimum, maximum in HEART_RATE_ZONES
+                    ],
+                    "restingHeartRate": rng.randint(50, 70),
+                },
+            }
+        ],
+        "activities-heart-intraday": {
+            "dataset": dataset,
+            "datasetInterval": 1,
+            "datasetType": "second",
+        },
+    }
+
+
+def write_heart_rate_day(archive_folder, date, seed=0):
+    folder_path = join(archive_folder, date)
+    makedirs(folder_path, exist_ok=True)
+    with open(
+        join(folder_path, "intra-day-heart-rate-series.json"), "w"
+    ) as file_handler:
+        json.dump(heart_rate_series(date, random.Random(seed)), file_handler)
+    return folder_path
+
+
+SLEEP_LEVELS = {
+    "classic": ["asleep", "restless", "awake"],
+    "stages": ["light", "deep", "light", "rem", "wake"],
+}
+FITBIT_TIME_STAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.000"
+
+
+def sleep_log(date, rng, sleep_type, hours=8):
+    start = datetime.strptime(date, "%Y-%m-%d") - timedelta(hours=1)
+    end = start + timedelta(hours=hours)
+    data = []
+    short_data = []
+    instant = start
+    while instant < end:
+        seconds = 30 * rng.randint(2, 60)
+        level = rng.choice(SLEEP_LEVELS[sleep_type])
+        data.append(
+            {
+                "dateTime": instant.strftime(FITBIT_TIME_STAMP_FORMAT),
+                "level": level,
+                "seconds": seconds,
+            }
+        )
+        # Short wakes within longer stages are reported separately in "shortData".
+        if sleep_type == "stages" and level != "wake" and seconds >= 300:
+            short_data.append(
+                {
+                    "dateTime": (instant + timedelta(seconds=120)).strftime(
+                        FITBIT_TIME_STAMP_FORMAT
+                    ),
+                    "level": "wake",
+                    "seconds": 30 * rng.randint(1, 4),
+                }
+            )
+        instant += timedelta(seconds=seconds)
+    levels = {"data": data, "summary": {}}
+    if sleep_type == "stages":
+        levels["shortData"] = short_data
+    minutes_in_bed = int((instant - start).total_seconds() // 60)
+    return {
+        "dateOfSleep": date,
+        "duration": minutes_in_bed * 60000,
+        "isMainSleep": True,
+        "levels": levels,
+        "logId": rng.randint(10**9, 10**10),
+        "minutesAsleep": minutes_in_bed - 30,
+        "minutesAwake": 30,
+        "startTime": start.strftime(FITBIT_TIME_STAMP_FORMAT),
+        "endTime": instant.strftime(FITBIT_TIME_STAMP_FORMAT),
+        "timeInBed": minutes_in_bed,
+        "type": sleep_type,
+    }
+
+
+def sleep_day(date, rng, sleep_type):
+    sleep = sleep_log(date, rng, sleep_type)
+    summary = {
+        "totalMinutesAsleep": sleep["minutesAsleep"],
+        "totalSleepRecords": 1,
+        "totalTimeInBed": sleep["timeInBed"],
+    }
+    if sleep_type == "stages":
+        summary["stages"] = {"deep": 60, "light": 240, "rem": 90, "wake": 30}
+    return {"sleep": [sleep], "summary": summary}
+
+
+def write_sleep_day(archive_folder, date, sleep_type="stages", seed=0):
+    folder_path = join(archive_folder, date)
+    makedirs(folder_path, exist_ok=True)
+    with open(join(folder_path, "sleep.json"), "w") as file_handler:
+        json.dump(sleep_day(date, random.Random(seed), sleep_type), file_handler)
+    return folder_path
+
+
+TCX_NAMESPACE = "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"
+
+
+def tcx_track_point(instant, index, rng, with_position=True):
+    parts = [
+        f"<Trackpoint><Time>{instant.strftime('%Y-%m-%dT%H:%M:%S')}.000-07:00</Time>"
+    ]
+    if with_position:
+        parts.append(
+            f"<Position><LatitudeDegrees>{37.7749 + index * 1e-5:.7f}</LatitudeDegrees>"
+            f"<LongitudeDegrees>{-122.4194 + index * 1e-5:.7f}</LongitudeDegrees></Position>"
+        )
+    parts.append(f"<AltitudeMeters>{15 + rng.uniform(-1, 1):.3f}</AltitudeMeters>")
+    parts.append(f"<DistanceMeters>{index * 1.4:.3f}</DistanceMeters>")
+    parts.append(f"<HeartRateBpm><Value>{rng.randint(90, 150)}</Value></HeartRateBpm>")
+    parts.append("</Trackpoint>")
+    return "".join(parts)
+
+
+def tcx_file(start, trackpoints, rng, with_position=True):
+    parts = [
+        f'<?xml version="1.0" encoding="UTF-8"?>\n<TrainingCenterDatabase xmlns="{TCX_NAMESPACE}">'
+        f'<Activities><Activity Sport="Running"><Id>{start.isoformat()}.000-07:00</Id>'
+        f'<Lap StartTime="{start.isoformat()}.000-07:00"><TotalTimeSeconds>{trackpoints}.0</TotalTimeSeconds>'
+        f"<DistanceMeters>{trackpoints * 1.4:.1f}</DistanceMeters><Calories>{trackpoints // 10}</Calories>"
+        "<Intensity>Active</Intensity><TriggerMethod>Manual</TriggerMethod><Track>"
+    ]
+    for index in range(trackpoints):
+        parts.append(
+            tcx_track_point(start + timedelta(seconds=index), index, rng, with_position)
+        )
+        # Fitbit sometimes reports more than one track point within a second.
+        if index % 60 == 0:
+            parts.append(
+                tcx_track_point(
+                    start + timedelta(seconds=index, milliseconds=500),
+                    index,
+                    rng,
+                    with_position,
+                )
+            )
+    parts.append(
+        "</Track></Lap><Creator><Name>Fitbit</Name></Creator></Activity></Activities></TrainingCenterDatabase>"
+    )
+    return "".join(parts)
+
+
+def write_tcx_file(folder_path, log_id, start, trackpoints, rng, with_position=True):
+    with open(join(folder_path, f"{log_id}.xml"), "w") as file_handler:
+        file_handler.write(tcx_file(start, trackpoints, rng, with_position))
+
+
+def get_log_ids(date, activities):
+    return [int(date.replace("-", "")) * 100 + index for index in range(activities)]
+
+
+def get_activity_start(date, index):
+    return datetime.strptime(date, "%Y-%m-%d") + timedelta(hours=7 + index * 4)
+
+
+ACTIVITY_NAMES = ["Run", "Walk", "Outdoor Bike", "Hike"]
+
+
+def activities_day(date, log_ids, trackpoints, rng):
+    activities = []
+    for index, log_id in enumerate(log_ids):
+        activities.append(
+            {
+                "activityParentName": rng.choice(ACTIVITY_NAMES),
+                "calories": trackpoints // 10,
+                "distance": trackpoints * 1.4 / 1000,
+                "duration": trackpoints * 1000,
+                "hasGps": True,
+                "logId": log_id,
+                "startDate": date,
+                "startTime": f"{7 + index * 4:02d}:00",
+                "steps": trackpoints * 2,
+            }
+        )
+    return {
+        "activities": activities,
+        "goals": {},
+        "summary": {
+            "steps": rng.randint(2000, 20000),
+            "floors": rng.randint(0, 30),
+            "elevation": rng.uniform(0, 100),
+            "sedentaryMinutes": rng.randint(400, 900),
+            "lightlyActiveMinutes": rng.randint(60, 300),
+            "fairlyActiveMinutes": rng.randint(0, 60),
+            "veryActiveMinutes": rng.randint(0, 60),
+        },
+    }
+
+
+def write_activity_day(archive_folder, date, activities=1, trackpoints=3600, seed=0):
+    rng = random.Random(seed)
+    folder_path = join(archive_folder, date)
+    makedirs(folder_path, exist_ok=True)
+    log_ids = get_log_ids(date, activities)
+    with open(join(folder_path, "activities.json"), "w") as file_handler:
+        json.dump(activities_day(date, log_ids, trackpoints, rng), file_handler)
+    for index, log_id in enumerate(log_ids):
+        write_tcx_file(
+            folder_path, log_id, get_activity_start(date, index), trackpoints, rng
+        )
+    return folder_path
+
+
+INTRADAY_RESOURCES = ["steps", "calories", "distance", "floors", "elevation"]
+
+
+def intraday_series(resource, date, rng):
+    dataset = []
+    for minute in range(1440):
+        steps = rng.choice([0, 0, 0, rng.randint(1, 120)])
+        value = {
+            "steps": steps,
+            "calories": round(1.2 + steps * 0.04, 2),
+            "distance": round(steps * 0.0007, 5),
+            "floors": 1 if steps > 100 and rng.random() < 0.05 else 0,
+        }.get(resource, 3.05 if steps > 100 and rng.random() < 0.05 else 0)
+        dataset.append(
+            {"time": f"{minute // 60:02d}:{minute % 60:02d}:00", "value": value}
+        )
+    return {
+        f"activities-{resource}": [
+            {"dateTime": date, "value": str(sum(point["value"] for point in dataset))}
+        ],
+        f"activities-{resource}-intraday": {
+            "dataset": dataset,
+            "datasetInterval": 1,
+            "datasetType": "minute",
+        },
+    }
+
+
+def write_intraday_day(archive_folder, date, seed=0):
+    folder_path = join(archive_folder, date)
+    makedirs(folder_path, exist_ok=True)
+    for resource in INTRADAY_RESOURCES:
+        # Same seed for every resource, so steps, calories and distance line up.
+        with open(
+            join(folder_path, f"intra-day-{resource}-series.json"), "w"
+        ) as file_handler:
+            json.dump(
+                intraday_series(resource, date, random.Random(seed)), file_handler
+            )
+    return folder_path
+
+
+def write_archive(archive_folder, start_date, days, activities=1, trackpoints=3600):
+    # Full day folders, the sender bootstraps the archive manifest from them on its
+    # first run.
+    # Sleep logs are classic for the first half of the days and stages after, like
+    # accounts from before 2019.
+    folder_paths = []
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    for day in range(days):
+        date = (start + timedelta(days=day)).strftime("%Y-%m-%d")
+        sleep_type = "classic" if day < days // 2 else "stages"
+        write_heart_rate_day(archive_folder, date, seed=day)
+        write_sleep_day(archive_folder, date, sleep_type, seed=day)
+        write_intraday_day(archive_folder, date, seed=day)
+        folder_paths.append(
+            write_activity_day(archive_folder, date, activities, trackpoints, seed=day)
+        )
+    return folder_paths
@@ -0,0 +1,61 @@
+import random
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from datetime import datetime
+from os.path import abspath, dirname
+
+# Needs to run from a folder with config.json, sender.py reads it on import.
+# python benchmarks/tcx_parser.py [trackpoints ...]
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from loader import object_to_row
+from benchmarks.synthetic import write_tcx_file
+from sender import iter_activity_details, parse_activity_details
+
+LOG_ID = 12345
+REPEAT = 3
+
+
+def consume(parser, folder_path):
+    for _ in parser(LOG_ID, folder_path):
+        pass
+
+
+def peak_memory(parser, folder_path):
+    tracemalloc.start()
+    consume(parser, folder_path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def benchmark(trackpoints):
+    folder_path = tempfile.mkdtemp()
+    write_tcx_file(
+        folder_path, LOG_ID, datetime(2021, 4, 10, 7), trackpoints, random.Random(0)
+    )
+    # Both parsers keep the last track point of a second. Synthetic files only repeat a
+    # second in adjacent track points, so the rows come out in the same order as well.
+    expected_rows = [
+        object_to_row(parsed_object)
+        for parsed_object in parse_activity_details(LOG_ID, folder_path)
+    ]
+    assert list(iter_activity_details(LOG_ID, folder_path)) == expected_rows
+    for parser in [parse_activity_details, iter_activity_details]:
+        seconds = min(
+            timeit.repeat(lambda: consume(parser, folder_path), number=1, repeat=REPEAT)
+        )
+        print(
+            f"{trackpoints} trackpoints {parser.__name__}: {seconds:.3f}s, peak {peak_memory(parser, folder_path) / 2 ** 20:.1f}MiB"
+        )
+
+
+def main():
+    for trackpoints in [int(argument) for argument in sys.argv[1:]] or [3600, 36000]:
+        benchmark(trackpoints)
+
+
+if __name__ == "__main__":
+    main()
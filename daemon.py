@@ -0,0 +1,274 @@
+import argparse
+import shlex
+import time
+import traceback
+from functools import partial
+
+import arrow
+import requests
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+import downloader
+import sender
+from archive import HEART_RATE_WINDOW_URL, FILE_URL_MAPPING, get_users, select_users
+from loader import LOADERS, LoadStats
+from metrics import MetricsGroup, add_metrics_arguments, start_metrics, finish_metrics
+from models import HeartRate, refresh_continuous_aggregates
+
+# Runs downloader.py and sender.py on a schedule in one long running process, and in
+# between polls today's heart rate and sleep straight in to the database, so dashboards
+# lag by minutes instead of days.
+# Polled rows aren't archived, the days are downloaded and loaded again once they are
+# complete.
+# Run from the folder with config.json,
+# e.g. python daemon.py --sender-arguments "--workers 2"
+
+metrics = sender.metrics
+# Served and written by the daemon, the downloader's requests and rate limit waits next
+# to the loads and polls.
+exposed_metrics = MetricsGroup(sender.metrics, downloader.metrics)
+
+
+class Task:
+    def __init__(self, name, interval_seconds, function):
+        self.name = name
+        self.interval_seconds = interval_seconds
+        self.function = function
+        self.next_run = time.monotonic()
+
+
+def run_tasks(tasks, metrics_file=None):
+    # Tasks run one at a time, a long backfill of the archive delays the polls until it
+    # is done.
+    while True:
+        task = min(tasks, key=lambda task: task.next_run)
+        wait_seconds = task.next_run - time.monotonic()
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        try:
+            with metrics.time("daemon_task", task=task.name):
+                task.function()
+        except Exception:
+            # Tried again on its next run, the daemon keeps going.
+            traceback.print_exc()
+            metrics.increment("daemon_task_failures", task=task.name)
+        task.next_run = time.monotonic() + task.interval_seconds
+        if metrics_file is not None:
+            exposed_metrics.write(metrics_file)
+
+
+def sync_archive(downloader_arguments, sender_arguments):
+    # Same as a cron job running the two scripts, completed days are archived and
+    # loaded.
+    downloader.main(downloader_arguments)
+    sender.main(sender_arguments)
+
+
+class LiveLoader:
+    # Loads polled batches the way sender.py loads a transaction, with its loader and
+    # retries.
+    def __init__(self, sender_arguments):
+        self.sleep_storage = sender_arguments.sleep_storage
+        self.load_batches = partial(
+            LOADERS[sender_arguments.loader], on_conflict=sender_arguments.on_conflict
+        )
+        self.retries = sender_arguments.load_retries
+        self.load_stats = LoadStats(metrics)
+
+    def load(self, user_id, batches):
+        transaction = sender.Transaction(("live", user_id))
+        for batch in batches:
+            if len(batch) == 0:
+                continue
+            batch.user_id = user_id
+            transaction.batches.append(batch)
+        if len(transaction.batches) == 0:
+            return
+        _, load_stats, loaded_days = sender.load_transaction(
+            transaction, self.load_batches, retries=self.retries
+        )
+        self.load_stats.merge(load_stats)
+        with metrics.time("refresh_continuous_aggregates"):
+            refresh_continuous_aggregates(
+                sender.engine, sender.get_refresh_windows(loaded_days)
+            )
+
+
+def get_last_heart_rate(user_id):
+    with sessionmaker(bind=sender.engine)() as session:
+        return (
+            session.query(func.max(HeartRate.time_stamp))
+            .filter(HeartRate.user_id == user_id)
+            .scalar()
+        )
+
+
+def get_live_days(start):
+    # Days from start's (a wall clock time) to today's, yesterday is only archived the
+    # day after tomorrow.
+    today = arrow.get(arrow.now().naive).floor("day")
+    return [
+        day.format("YYYY-MM-DD")
+        for day in arrow.Arrow.range("day", arrow.get(start).floor("day"), today)
+    ]
+
+
+def fetch_json(user, url):
+    try:
+        response = downloader.fetch(user, url)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as exception:
+        print(f"Polling {url} failed with {exception}")
+        metrics.increment("live_poll_failures", user=user.user_id)
+        return None
+    return response.json()
+
+
+class HeartRatePoller:
+    # Fetches the minutes since the last sample from the intraday time window endpoint.
+    # The last sample's minute is fetched again, its samples are upserted.
+    def __init__(self, user, live_loader):
+        self.user = user
+        self.live_loader = live_loader
+        # Looked up on the first poll, once the archive run has created the tables.
+        self.last_time_stamp = None
+
+    def poll(self):
+        now = arrow.now().naive
+        if self.last_time_stamp is None:
+            yesterday = arrow.get(now).floor("day").shift(days=-1).naive
+            last_time_stamp = get_last_heart_rate(self.user.user_id)
+            self.last_time_stamp = max(last_time_stamp or yesterday, yesterday)
+        for day in get_live_days(self.last_time_stamp):
+            start = "00:00"
+            if day == arrow.get(self.last_time_stamp).format("YYYY-MM-DD"):
+                start = arrow.get(self.last_time_stamp).format("HH:mm")
+            end = "23:59"
+            if day == arrow.get(now).format("YYYY-MM-DD"):
+                end = arrow.get(now).format("HH:mm")
+            series_obj = fetch_json(
+                self.user, HEART_RATE_WINDOW_URL.format(day, start, end)
+            )
+            if series_obj is None:
+                return
+            batch = sender.parse_heart_rate_dataset(
+                sender.day_epoch(day),
+                series_obj["activities-heart-intraday"]["dataset"],
+            )
+            metrics.increment("live_rows", len(batch), table=batch.table_name)
+            self.live_loader.load(self.user.user_id, [batch])
+            if len(batch) > 0:
+                _, end_time_stamp = batch.get_time_range()
+                self.last_time_stamp = arrow.get(end_time_stamp).naive
+                # Time between the newest sample and now, how far behind the dashboards
+                # are.
+                metrics.observe(
+                    "live_lag",
+                    (now - self.last_time_stamp).total_seconds(),
+                    user=self.user.user_id,
+                )
+
+
+class SleepPoller:
+    # Sleep has no time window endpoint, yesterday's and today's logs are fetched whole
+    # and upserted.
+    def __init__(self, user, live_loader):
+        self.user = user
+        self.live_loader = live_loader
+
+    def poll(self):
+        for day in get_live_days(arrow.now().shift(days=-1).naive):
+            sleep_obj = fetch_json(
+                self.user, FILE_URL_MAPPING["sleep.json"].format(day)
+            )
+            if sleep_obj is None:
+                return
+            batches = list(
+                sender.parse_sleep_day(sleep_obj, self.live_loader.sleep_storage)
+            )
+            for batch in batches:
+                metrics.increment("live_rows", len(batch), table=batch.table_name)
+            self.live_loader.load(self.user.user_id, batches)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Keeps the archive and the database up to date, polling today's heart rate and sleep in between"
+    )
+    parser.add_argument(
+        "--heart-rate-interval",
+        type=int,
+        default=5,
+        help="minutes between polls of today's heart rate",
+    )
+    parser.add_argument(
+        "--sleep-interval",
+        type=int,
+        default=30,
+        help="minutes between polls of yesterday's and today's sleep",
+    )
+    parser.add_argument(
+        "--archive-interval",
+        type=int,
+        default=6,
+        help="hours between runs of downloader.py and sender.py for the completed days",
+    )
+    parser.add_argument(
+        "--downloader-arguments",
+        default="",
+        help='passed on to downloader.py, e.g. "--only heart,sleep"',
+    )
+    parser.add_argument(
+        "--sender-arguments",
+        default="",
+        help="passed on to sender.py, its --users, --sleep-storage, --loader and --on-conflict apply to the polls as well",
+    )
+    add_metrics_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    downloader_arguments = downloader.parse_arguments(
+        shlex.split(arguments.downloader_arguments)
+    )
+    sender_arguments = sender.parse_arguments(shlex.split(arguments.sender_arguments))
+    for sub_arguments in [downloader_arguments, sender_arguments]:
+        # Every archive run would start another server on the same port.
+        assert (
+            sub_arguments.metrics_port is None and sub_arguments.metrics_file is None
+        ), "Pass --metrics-port and --metrics-file to daemon.py instead"
+    start_metrics(exposed_metrics, arguments)
+    tasks = [
+        Task(
+            "archive",
+            arguments.archive_interval * 3600,
+            partial(sync_archive, downloader_arguments, sender_arguments),
+        )
+    ]
+    live_loader = LiveLoader(sender_arguments)
+    for user in select_users(get_users(sender.config), sender_arguments.user_ids):
+        fitbit_user = downloader.FitbitUser(user)
+        tasks.append(
+            Task(
+                f"heart_rate_{user['user_id']}",
+                arguments.heart_rate_interval * 60,
+                HeartRatePoller(fitbit_user, live_loader).poll,
+            )
+        )
+        tasks.append(
+            Task(
+                f"sleep_{user['user_id']}",
+                arguments.sleep_interval * 60,
+                SleepPoller(fitbit_user, live_loader).poll,
+            )
+        )
+    try:
+        run_tasks(tasks, arguments.metrics_file)
+    finally:
+        finish_metrics(exposed_metrics, arguments)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,105 +1,408 @@
 from shutil import move
-from os import listdir, makedirs
-from os.path import isfile, join, isdir
+from os import makedirs
+from os.path import join
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import argparse
 import json
+import random
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
 import arrow
 
-
-TCX_FILE_URL = "https://api.fitbit.com/1/user/-/activities/{}.tcx"
-FILE_URL_MAPPING = {
-    "intra-day-heart-rate-series.json": "https://api.fitbit.com/1/user/-/activities/heart/date/{}/1d/1sec.json",
-    "activities.json": "https://api.fitbit.com/1/user/-/activities/date/{}.json",
-    "sleep.json": "https://api.fitbit.com/1.2/user/-/sleep/date/{}.json",
-}
-
-ARCHIVAL_FILE_LISTING = FILE_URL_MAPPING.keys()
+from archive import (
+    FITBIT_API_URL,
+    TCX_FILE_URL,
+    FILE_URL_MAPPING,
+    SLEEP_RANGE_URL,
+    SLEEP_RANGE_MAX_DAYS,
+    ARCHIVAL_FILE_LISTING,
+    DATA_TYPES,
+    Manifest,
+    get_users,
+    select_users,
+    add_selection_arguments,
+    content_checksum,
+    get_activity_log_ids,
+    get_data_type,
+    get_file_type,
+    get_stored_file_name,
+    open_for_archiving,
+    remove_other_stored_files,
+)
+from metrics import Metrics, add_metrics_arguments, start_metrics, finish_metrics
 
 config = {}
 with open("config.json") as config_file_handler:
     config = json.load(config_file_handler)
 
+DOWNLOAD_WORKERS = config.get("download_workers", 4)
+DOWNLOAD_RETRIES = config.get("download_retries", 5)
+# Requests left unused every hour, so that other apps using the same token still work.
+RATE_LIMIT_RESERVE = config.get("rate_limit_reserve", 0)
+REQUEST_TIMEOUT_SECONDS = 60
+# null, "gzip" or "zstd". Files already in the archive are read whatever they are stored
+# as.
+ARCHIVE_COMPRESSION = config.get("archive_compression", None)
+# Days of sleep fetched per request while backfilling, 1 fetches every day on its own.
+SLEEP_RANGE_DAYS = min(
+    config.get("sleep_range_days", SLEEP_RANGE_MAX_DAYS), SLEEP_RANGE_MAX_DAYS
+)
+# Where the api is fetched from,
+# e.g. "http://127.0.0.1:8080" for benchmarks/mock_fitbit.py.
+API_URL = config.get("fitbit_api_url", FITBIT_API_URL).rstrip("/")
 
-def get_folder_path(date_string):
-    return join(config["fitbit_data_archival_folder"], date_string)
+metrics = Metrics("fitbit_downloader")
 
 
-def get_archived_files(folder_path):
-    if isdir(folder_path):
-        return [f for f in listdir(folder_path) if isfile(join(folder_path, f))]
-    else:
-        return None
+class RateLimiter:
+    # Shared between a user's download threads, keeps track of the hourly quota of the
+    # user's token from the response headers.
+    # https://dev.fitbit.com/build/reference/web-api/developer-guide/application-design/#Rate-Limits
+    def __init__(self, reserve, user_id):
+        self.reserve = reserve
+        self.user_id = user_id
+        self.remaining = None
+        self.reset_at = None
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.remaining is not None and self.remaining <= self.reserve:
+                wait_seconds = self.reset_at - time.monotonic()
+                if wait_seconds > 0:
+                    print(
+                        f"Rate limit of {self.user_id} reached, waiting {wait_seconds:.0f}s for it to reset"
+                    )
+                    metrics.increment("rate_limit_waits", user=self.user_id)
+                    # Holding the lock, every other download thread of the user waits as
+                    # well.
+                    with metrics.time("rate_limit_wait", user=self.user_id):
+                        time.sleep(wait_seconds)
+                self.remaining = None
+            if self.remaining is not None:
+                # Accounts for requests in flight before their response headers come
+                # back.
+                self.remaining -= 1
+
+    def update(self, response):
+        # False when the response doesn't say when the quota resets.
+        remaining = response.headers.get("Fitbit-Rate-Limit-Remaining")
+        reset = response.headers.get("Fitbit-Rate-Limit-Reset")
+        if response.status_code == 429:
+            remaining = 0
+            reset = response.headers.get("Retry-After", reset)
+        if remaining is None or reset is None:
+            return False
+        with self.lock:
+            self.remaining = int(remaining)
+            # A second more than asked for, the reset header is rounded down.
+            self.reset_at = time.monotonic() + int(reset) + 1
+        return True
+
+
+class FitbitUser:
+    # Everything the download threads of one user share, users don't wait on each
+    # other's rate limit.
+    def __init__(self, user):
+        self.user_id = user["user_id"]
+        self.archive_folder = user["archive_folder"]
+        self.rate_limiter = RateLimiter(RATE_LIMIT_RESERVE, self.user_id)
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = "Bearer " + user["fitbit_token"]
+        for prefix in ["https://", "http://"]:
+            self.session.mount(
+                prefix, HTTPAdapter(pool_connections=1, pool_maxsize=DOWNLOAD_WORKERS)
+            )
+        makedirs(self.archive_folder, exist_ok=True)
+        self.manifest = Manifest(self.archive_folder)
+
+
+def backoff(attempt):
+    return min(300, 2**attempt) + random.uniform(0, 1)
+
 
+def fetch(user, url):
+    # URLs from archive.py are absolute, they are moved to the configured api.
+    if url.startswith(FITBIT_API_URL):
+        url = API_URL + url[len(FITBIT_API_URL) :]
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        user.rate_limiter.acquire()
+        try:
+            response = user.session.get(url, timeout=REQUEST_TIMEOUT_SECONDS)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            metrics.increment("connection_errors")
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            time.sleep(backoff(attempt))
+            continue
+        reset_known = user.rate_limiter.update(response)
+        metrics.increment("http_responses", status=response.status_code)
+        if response.status_code == 429:
+            # Next acquire waits until the quota resets, without a reset header the
+            # request is backed off like a 5xx instead.
+            if not reset_known and attempt < DOWNLOAD_RETRIES:
+                time.sleep(backoff(attempt))
+            continue
+        if response.status_code >= 500 and attempt < DOWNLOAD_RETRIES:
+            time.sleep(backoff(attempt))
+            continue
+        return response
+    return response
 
-def download_file(url, file_path, json_flag=True):
+
+def get_folder_path(user, date_string):
+    return join(user.archive_folder, date_string)
+
+
+def archive_file(user, date_string, file_name, content, status_code, tcx_files=None):
+    stored_file_name = get_stored_file_name(file_name, ARCHIVE_COMPRESSION)
+    file_path = join(get_folder_path(user, date_string), stored_file_name)
     temp_file_path = file_path + "_bk"
-    response = requests.get(
-        url, headers={"Authorization": "Bearer " + config["fitbit_token"]}
+    with metrics.time("archive", file_type=get_file_type(file_name)):
+        with open_for_archiving(
+            temp_file_path, ARCHIVE_COMPRESSION
+        ) as file_write_handler:
+            file_write_handler.write(content)
+    move(temp_file_path, file_path)
+    remove_other_stored_files(
+        join(get_folder_path(user, date_string), file_name), ARCHIVE_COMPRESSION
     )
+    user.manifest.record(
+        date_string,
+        file_name,
+        len(content),
+        content_checksum(content),
+        status_code,
+        tcx_files,
+        stored_file_name,
+    )
+
+
+def download_file(user, url, date_string, file_name, json_flag=True):
+    file_type = get_file_type(file_name)
+    try:
+        # Includes retries and waiting for the rate limit.
+        with metrics.time("download", file_type=file_type):
+            response = fetch(user, url)
+    except requests.exceptions.RequestException as exception:
+        print(f"Downloading {url} failed with {exception}")
+        metrics.increment("failed_downloads", file_type=file_type)
+        return
     try:
         response.raise_for_status()
-        if json_flag:
-            json_response = response.json()
-            with open(temp_file_path, "w") as file_write_handler:
-                json.dump(json_response, file_write_handler)
-        else:
-            xml_response = response.text
-            with open(temp_file_path, "w") as file_write_handler:
-                file_write_handler.write(xml_response)
-        move(temp_file_path, file_path)
+        # Response bytes are archived as they came in, json is only decoded to find the
+        # tcx files.
+        content = response.content
+        metrics.increment("bytes_downloaded", len(content), file_type=file_type)
+        tcx_files = None
+        if json_flag and file_name == "activities.json":
+            tcx_files = [
+                str(activity_logId) + ".xml"
+                for activity_logId in get_activity_log_ids(json.loads(content))
+            ]
+        archive_file(
+            user, date_string, file_name, content, response.status_code, tcx_files
+        )
     except requests.exceptions.HTTPError:
         print("Status code is " + str(response.status_code))
         print("Response headers are " + str(response.headers))
         print("Response is " + response.text)
+        metrics.increment("failed_downloads", file_type=file_type)
+        user.manifest.record(date_string, file_name, None, None, response.status_code)
+
+
+def get_files_to_download(
+    date_string, manifest, data_types, force, fetched_files=frozenset()
+):
+    # --force downloads the day's files again even if they are in the archive,
+    # except for the ones fetched by a range request in this run.
+    if force:
+        file_names = manifest.get_expected_files(date_string)
+    else:
+        file_names = manifest.get_missing_files(date_string)
+    return [
+        file_name
+        for file_name in file_names
+        if get_data_type(file_name) in data_types
+        and (date_string, file_name) not in fetched_files
+    ]
 
 
-def get_activity_log_file_names(date_string_folder_path):
-    activity_filename = join(date_string_folder_path, "activities.json")
-    with open(activity_filename) as activity_file_handler:
-        activity_obj = json.load(activity_file_handler)
-        activities_list = activity_obj["activities"]
-        activity_logIds = [activity["logId"] for activity in activities_list]
-    return [(str(activity_logId) + ".xml") for activity_logId in activity_logIds]
+def get_sleep_day(sleep_logs):
+    # Same shape as a day of the per day sleep endpoint, the range endpoint has no daily
+    # summary.
+    summary = {
+        "totalMinutesAsleep": sum(sleep["minutesAsleep"] for sleep in sleep_logs),
+        "totalSleepRecords": len(sleep_logs),
+        "totalTimeInBed": sum(sleep["timeInBed"] for sleep in sleep_logs),
+    }
+    stages_logs = [sleep for sleep in sleep_logs if sleep["type"] == "stages"]
+    if len(stages_logs) > 0:
+        summary["stages"] = {
+            stage: sum(
+                sleep["levels"]["summary"].get(stage, {}).get("minutes", 0)
+                for sleep in stages_logs
+            )
+            for stage in ["deep", "light", "rem", "wake"]
+        }
+    return {"sleep": sleep_logs, "summary": summary}
 
 
-def ensure_download(date_string):
-    date_string_folder_path = get_folder_path(date_string)
-    folder_listing = get_archived_files(date_string_folder_path)
-    if folder_listing is None:
-        makedirs(date_string_folder_path)
-        folder_listing = []
+def download_sleep_range(user, date_strings):
+    # date_strings are sorted and within SLEEP_RANGE_DAYS, only these days are archived.
+    # Returns the days that were archived.
+    url = SLEEP_RANGE_URL.format(date_strings[0], date_strings[-1])
+    try:
+        with metrics.time("download", file_type="sleep_range"):
+            response = fetch(user, url)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as exception:
+        # The days are downloaded one by one instead.
+        print(f"Downloading {url} failed with {exception}")
+        metrics.increment("failed_downloads", file_type="sleep_range")
+        return []
+    metrics.increment(
+        "bytes_downloaded", len(response.content), file_type="sleep_range"
+    )
+    sleep_logs_by_day = {}
+    for sleep in response.json()["sleep"]:
+        sleep_logs_by_day.setdefault(sleep["dateOfSleep"], []).append(sleep)
+    for date_string in date_strings:
+        makedirs(get_folder_path(user, date_string), exist_ok=True)
+        content = json.dumps(
+            get_sleep_day(sleep_logs_by_day.get(date_string, []))
+        ).encode()
+        archive_file(user, date_string, "sleep.json", content, response.status_code)
+    return date_strings
+
 
-    remaining_files = [
-        file for file in ARCHIVAL_FILE_LISTING if (file not in folder_listing)
+def download_sleep_ranges(user, date_strings, data_types, force):
+    # Backfilling sleep a day at a time takes one request per day out of the hourly
+    # quota.
+    # Returns the (day, "sleep.json") files that were fetched.
+    fetched_files = set()
+    if SLEEP_RANGE_DAYS <= 1:
+        return fetched_files
+    needed_date_strings = [
+        date_string
+        for date_string in date_strings
+        if "sleep.json"
+        in get_files_to_download(date_string, user.manifest, data_types, force)
     ]
+    date_ranges = []
+    for date_string in needed_date_strings:
+        if (
+            len(date_ranges) > 0
+            and (arrow.get(date_string) - arrow.get(date_ranges[-1][0])).days
+            < SLEEP_RANGE_DAYS
+        ):
+            date_ranges[-1].append(date_string)
+        else:
+            date_ranges.append([date_string])
+    for date_range in date_ranges:
+        # Single days go through the per day endpoint with the rest of the day's files.
+        if len(date_range) > 1:
+            for date_string in download_sleep_range(user, date_range):
+                fetched_files.add((date_string, "sleep.json"))
+    return fetched_files
+
+
+def ensure_download(
+    date_string, user, data_types=DATA_TYPES, force=False, fetched_files=frozenset()
+):
+    # Only the manifest is consulted, days that are complete don't touch the file
+    # system.
+    remaining_files = get_files_to_download(
+        date_string, user.manifest, data_types, force, fetched_files
+    )
+    if len(remaining_files) == 0:
+        return
+    makedirs(get_folder_path(user, date_string), exist_ok=True)
+
     for remaining_file in remaining_files:
-        url = FILE_URL_MAPPING[remaining_file].format(date_string)
-        file_path = join(date_string_folder_path, remaining_file)
-        download_file(url, file_path)
+        if remaining_file in ARCHIVAL_FILE_LISTING:
+            url = FILE_URL_MAPPING[remaining_file].format(date_string)
+            download_file(user, url, date_string, remaining_file)
 
-    tcx_log_file_names = get_activity_log_file_names(date_string_folder_path)
-    remaining_tcx_log_files = [
-        tcx_file for tcx_file in tcx_log_file_names if (tcx_file not in folder_listing)
-    ]
-    for each_tcx_file in remaining_tcx_log_files:
-        url = TCX_FILE_URL.format(each_tcx_file.split(".")[0])
-        file_path = join(date_string_folder_path, each_tcx_file)
-        download_file(url, file_path, json_flag=False)
+    # The tcx files are known once activities.json is in. If it failed they are retried
+    # on the next run.
+    for remaining_file in get_files_to_download(
+        date_string, user.manifest, data_types, force, fetched_files
+    ):
+        if remaining_file not in ARCHIVAL_FILE_LISTING:
+            url = TCX_FILE_URL.format(remaining_file.split(".")[0])
+            download_file(user, url, date_string, remaining_file, json_flag=False)
+
+
+def download_user(user, date_strings, data_types=DATA_TYPES, force=False):
+    fetched_files = download_sleep_ranges(user, date_strings, data_types, force)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        # list() to surface exceptions from the download threads.
+        list(
+            executor.map(
+                partial(
+                    ensure_download,
+                    user=user,
+                    data_types=data_types,
+                    force=force,
+                    fetched_files=fetched_files,
+                ),
+                date_strings,
+            )
+        )
 
 
 def return_formatted_string(arrow_object):
     return arrow_object.format("YYYY-MM-DD")
 
 
-def main():
-    start_date = arrow.get(config["start_date"])
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Downloads fitbit data in to the local archive"
+    )
+    add_selection_arguments(parser)
+    add_metrics_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(arguments=None):
+    # daemon.py runs it with arguments of its own.
+    arguments = arguments or parse_arguments()
+    start_metrics(metrics, arguments)
+    start_date = arrow.get(arguments.from_date or config["start_date"])
     current_date = start_date
+    date_strings = []
     while (arrow.now() - current_date).days > 1:
-        ensure_download(return_formatted_string(current_date))
+        if (
+            arguments.to_date is not None
+            and return_formatted_string(current_date) > arguments.to_date
+        ):
+            break
+        date_strings.append(return_formatted_string(current_date))
         # Advancing date to next..
         current_date = current_date.shift(days=1)
+    fitbit_users = [
+        FitbitUser(user) for user in select_users(get_users(config), arguments.user_ids)
+    ]
+    # Every user gets DOWNLOAD_WORKERS threads of their own.
+    with ThreadPoolExecutor(max_workers=len(fitbit_users)) as executor:
+        list(
+            executor.map(
+                partial(
+                    download_user,
+                    date_strings=date_strings,
+                    data_types=arguments.only,
+                    force=arguments.force,
+                ),
+                fitbit_users,
+            )
+        )
+    finish_metrics(metrics, arguments)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
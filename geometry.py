@@ -0,0 +1,40 @@
+import struct
+
+# Hex encoded EWKB of the geometries the parsers emit, postgis reads it as is in COPY
+# and in ST_GeomFromEWKT (the ORM path) without parsing coordinates out of text.
+# X is the longitude and Y the latitude, the order postgis expects for SRID 4326.
+# https://libgeos.org/specifications/wkb/#extended-wkb
+SRID = 4326
+EWKB_POINT = 1
+EWKB_LINESTRING = 2
+EWKB_M_FLAG = 0x40000000
+EWKB_SRID_FLAG = 0x20000000
+
+
+def point_ewkb(longitude, latitude, srid=SRID):
+    return struct.pack(
+        "<BIIdd", 1, EWKB_SRID_FLAG | EWKB_POINT, srid, longitude, latitude
+    ).hex()
+
+
+def read_point_ewkb(value):
+    # (longitude, latitude) of a point_ewkb value.
+    return struct.unpack_from("<dd", bytes.fromhex(value), 9)
+
+
+def linestring_m_ewkb(longitudes, latitudes, measures, srid=SRID):
+    # Vertices are (longitude, latitude, measure), the measure of a track is the epoch
+    # time of the point.
+    coordinates = []
+    for vertex in zip(longitudes, latitudes, measures):
+        coordinates.extend(vertex)
+    return (
+        struct.pack(
+            "<BIII",
+            1,
+            EWKB_SRID_FLAG | EWKB_M_FLAG | EWKB_LINESTRING,
+            srid,
+            len(longitudes),
+        )
+        + struct.pack(f"<{len(coordinates)}d", *coordinates)
+    ).hex()
@@ -0,0 +1,284 @@
+import enum
+import time
+from array import array
+from datetime import datetime, timezone
+from itertools import islice
+
+from sqlalchemy import TIMESTAMP, Integer
+
+from archive import DEFAULT_USER_ID
+from models import Base, decompress_chunks, get_data_columns
+
+# Rows handed to the loader are plain tuples in `Model.__table__.columns` order without
+# user_id (see rows.py), every row of a batch belongs to the batch's user.
+# TIMESTAMP columns travel as epoch seconds and are turned back into wall clock time
+# stamps by postgres while moving rows out of the staging table.
+COPY_NULL = "\\N"
+COPY_READ_SIZE = 1 << 16
+# Upper bound of rows in a batch built from a row generator.
+BATCH_ROWS = 10000
+
+
+def group_by_table(parsed_objects):
+    # ORM objects and rows.py rows both know their table.
+    objects_by_table = {}
+    for parsed_object in parsed_objects:
+        objects_by_table.setdefault(parsed_object.__table__, []).append(parsed_object)
+    return objects_by_table
+
+
+def object_to_row(parsed_object):
+    row = []
+    for column in get_data_columns(parsed_object.__table__):
+        value = getattr(parsed_object, column.name)
+        if isinstance(value, datetime):
+            value = value.timestamp()
+        row.append(value)
+    return tuple(row)
+
+
+def is_time_column(column):
+    return isinstance(column.type, TIMESTAMP)
+
+
+class ColumnBatch:
+    # Rows of a single table stored column wise. Only the table name travels with it so
+    # that batches stay cheap to pickle when they come back from parser processes.
+    # Parsers don't know whose archive they read, the sender sets user_id before
+    # loading.
+    def __init__(self, table_name, columns, user_id=DEFAULT_USER_ID):
+        self.table_name = table_name
+        self.columns = columns
+        self.user_id = user_id
+
+    @classmethod
+    def from_rows(cls, table, rows):
+        # Rows can be a generator, they are appended one by one without materialising
+        # them first.
+        columns = [
+            array("d") if is_time_column(column) and not column.nullable else []
+            for column in get_data_columns(table)
+        ]
+        appends = [column.append for column in columns]
+        for row in rows:
+            for append, value in zip(appends, row):
+                append(value)
+        return cls(table.name, columns)
+
+    @property
+    def table(self):
+        return Base.metadata.tables[self.table_name]
+
+    def rows(self):
+        return zip(*self.columns)
+
+    def get_time_range(self):
+        column_names = [column.name for column in get_data_columns(self.table)]
+        time_stamps = self.columns[column_names.index("time_stamp")]
+        return min(time_stamps), max(time_stamps)
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+
+def iter_batches(table, rows, batch_rows=BATCH_ROWS):
+    rows = iter(rows)
+    while True:
+        batch = ColumnBatch.from_rows(table, islice(rows, batch_rows))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def batches_from_rows(parsed_rows):
+    return [
+        ColumnBatch.from_rows(table, rows)
+        for table, rows in group_by_table(parsed_rows).items()
+    ]
+
+
+def objects_from_batch(batch):
+    model = next(
+        mapper.class_
+        for mapper in Base.registry.mappers
+        if mapper.local_table is batch.table
+    )
+    data_columns = get_data_columns(batch.table)
+    time_columns = [is_time_column(column) for column in data_columns]
+    column_names = [column.name for column in data_columns]
+    objects = []
+    for row in batch.rows():
+        values = {"user_id": batch.user_id}
+        for column_name, is_time, value in zip(column_names, time_columns, row):
+            if is_time and value is not None:
+                value = datetime.fromtimestamp(value, timezone.utc)
+            values[column_name] = value
+        objects.append(model(**values))
+    return objects
+
+
+def format_copy_value(value):
+    if value is None:
+        return COPY_NULL
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, str):
+        return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+    return str(value)
+
+
+def format_copy_row(row):
+    return "\t".join(map(format_copy_value, row)) + "\n"
+
+
+class CopyRowStream:
+    # File like object consumed by `copy_expert`, rows are formatted only when postgres
+    # asks for more data.
+    def __init__(self, rows):
+        self.lines = map(format_copy_row, rows)
+        self.pending = ""
+        self.row_count = 0
+
+    def read(self, size=-1):
+        chunks = [self.pending]
+        buffered = len(self.pending)
+        for line in self.lines:
+            chunks.append(line)
+            buffered += len(line)
+            self.row_count += 1
+            if 0 <= size <= buffered:
+                break
+        data = "".join(chunks)
+        if 0 <= size < len(data):
+            data, self.pending = data[:size], data[size:]
+        else:
+            self.pending = ""
+        return data
+
+
+def staging_column_type(column, dialect):
+    if is_time_column(column):
+        return "double precision"
+    if isinstance(column.type, Integer):
+        # Parsers hand over floats for some integer columns (distance, duration),
+        # numeric keeps the same rounding behaviour the ORM inserts got from postgres
+        # assignment casts.
+        return "numeric"
+    return column.type.compile(dialect=dialect)
+
+
+def select_expression(column):
+    if is_time_column(column):
+        return f"to_timestamp({column.name}) AT TIME ZONE 'UTC'"
+    return column.name
+
+
+def get_conflict_clause(table, on_conflict):
+    key_columns = [column.name for column in table.primary_key.columns]
+    if on_conflict == "nothing":
+        return f"ON CONFLICT ({', '.join(key_columns)}) DO NOTHING"
+    updated_columns = [
+        column.name for column in table.columns if column.name not in key_columns
+    ]
+    if len(updated_columns) == 0:
+        return f"ON CONFLICT ({', '.join(key_columns)}) DO NOTHING"
+    return f"ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET " + ", ".join(
+        f"{column_name} = EXCLUDED.{column_name}" for column_name in updated_columns
+    )
+
+
+def decompress_batch_chunks(connection, batch):
+    # Rows of a day folder that changed after its chunk was compressed.
+    start, end = batch.get_time_range()
+    decompress_chunks(
+        connection,
+        batch.table,
+        datetime.utcfromtimestamp(start),
+        datetime.utcfromtimestamp(end + 1),
+    )
+
+
+def copy_rows(connection, table, rows, on_conflict="update", user_id=DEFAULT_USER_ID):
+    # Only the parsed columns are staged, user_id is the same for every row and added
+    # while inserting.
+    staging_table = f"staging_{table.name}"
+    data_columns = get_data_columns(table)
+    column_names = ", ".join(column.name for column in data_columns)
+    column_definitions = ", ".join(
+        f"{column.name} {staging_column_type(column, connection.dialect)}"
+        for column in data_columns
+    )
+    connection.exec_driver_sql(
+        f"CREATE TEMP TABLE IF NOT EXISTS {staging_table} ({column_definitions}) ON COMMIT DELETE ROWS"
+    )
+    stream = CopyRowStream(rows)
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {staging_table} ({column_names}) FROM STDIN", stream, COPY_READ_SIZE
+        )
+    select_expressions = ", ".join(select_expression(column) for column in data_columns)
+    # A row can only be updated once per statement, duplicate keys within the staged
+    # rows are dropped first.
+    key_column_names = ", ".join(
+        column.name for column in table.primary_key.columns if column.name != "user_id"
+    )
+    connection.exec_driver_sql(
+        f"INSERT INTO {table.name} ({column_names}, user_id) SELECT DISTINCT ON ({key_column_names}) {select_expressions}, %(user_id)s FROM {staging_table} ORDER BY {key_column_names} {get_conflict_clause(table, on_conflict)}",
+        {"user_id": user_id},
+    )
+    connection.exec_driver_sql(f"TRUNCATE {staging_table}")
+    return stream.row_count
+
+
+class LoadStats:
+    def __init__(self, metrics=None):
+        self.tables = {}
+        self.metrics = metrics
+
+    def record(self, table_name, row_count, seconds):
+        total_rows, total_seconds = self.tables.get(table_name, (0, 0.0))
+        self.tables[table_name] = (total_rows + row_count, total_seconds + seconds)
+        if self.metrics is not None:
+            self.metrics.increment("rows_loaded", row_count, table=table_name)
+            self.metrics.observe("load", seconds, table=table_name)
+
+    def merge(self, load_stats):
+        # Stats of a writer thread's transaction, merged once it is committed.
+        for table_name, (row_count, seconds) in load_stats.tables.items():
+            self.record(table_name, row_count, seconds)
+
+    def report(self, loader_name):
+        for table_name, (row_count, seconds) in sorted(self.tables.items()):
+            rows_per_second = row_count / seconds if seconds > 0 else 0
+            print(
+                f"[{loader_name}] {table_name}: {row_count} rows in {seconds:.2f}s ({rows_per_second:.0f} rows/sec)"
+            )
+
+
+def copy_batches(session, batches, load_stats, on_conflict="update"):
+    connection = session.connection()
+    for batch in batches:
+        start = time.perf_counter()
+        decompress_batch_chunks(connection, batch)
+        row_count = copy_rows(
+            connection, batch.table, batch.rows(), on_conflict, batch.user_id
+        )
+        load_stats.record(batch.table_name, row_count, time.perf_counter() - start)
+
+
+def add_batches(session, batches, load_stats, on_conflict=None):
+    # The original ORM path, flushed per table so that it can be compared with
+    # `copy_batches`.
+    # Rows that are already in the database fail the batch, on_conflict isn't supported.
+    for batch in batches:
+        start = time.perf_counter()
+        decompress_batch_chunks(session.connection(), batch)
+        session.add_all(objects_from_batch(batch))
+        session.flush()
+        load_stats.record(batch.table_name, len(batch), time.perf_counter() - start)
+
+
+LOADERS = {
+    "copy": copy_batches,
+    "orm": add_batches,
+}
@@ -0,0 +1,171 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import replace
+
+# Counters and stage timers for downloader.py and sender.py, exposed in the prometheus
+# text format.
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+# Written to a file for node_exporter's textfile collector (--metrics-file) or served on
+# /metrics (--metrics-port).
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Metrics:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        # (name, ((label, value), ..)) -> value
+        self.counters = {}
+        # (name, ((label, value), ..)) -> (count, seconds)
+        self.timers = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            count, total_seconds = self.timers.get(key, (0, 0.0))
+            self.timers[key] = (count + 1, total_seconds + seconds)
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, items, **labels):
+        # Times a generator, only the time spent producing items counts and not the
+        # consumer's.
+        seconds = 0.0
+        iterator = iter(items)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start
+                yield item
+        finally:
+            self.observe(name, seconds, **labels)
+
+    def snapshot(self):
+        # Plain dicts, sent back from the sender's parser processes and merged in to the
+        # main process.
+        with self.lock:
+            return dict(self.counters), dict(self.timers)
+
+    def merge(self, snapshot):
+        counters, timers = snapshot
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (count, seconds) in timers.items():
+                total_count, total_seconds = self.timers.get(key, (0, 0.0))
+                self.timers[key] = (total_count + count, total_seconds + seconds)
+
+    def render(self):
+        counters, timers = self.snapshot()
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            metric_name = f"{self.prefix}_{name}_total"
+            lines.append(f"# TYPE {metric_name} counter")
+            for (key_name, labels), value in sorted(counters.items()):
+                if key_name == name:
+                    lines.append(f"{metric_name}{format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in timers}):
+            metric_name = f"{self.prefix}_{name}_seconds"
+            lines.append(f"# TYPE {metric_name} summary")
+            for (key_name, labels), (count, seconds) in sorted(timers.items()):
+                if key_name == name:
+                    lines.append(f"{metric_name}_sum{format_labels(labels)} {seconds}")
+                    lines.append(f"{metric_name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, file_path):
+        # Replaced in one go, the textfile collector never reads a partial file.
+        with open(file_path + ".tmp", "w") as metrics_file_handler:
+            metrics_file_handler.write(self.render())
+        replace(file_path + ".tmp", file_path)
+
+    def serve(self, port):
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *arguments):
+                pass
+
+        server = ThreadingHTTPServer(("", port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving metrics on http://localhost:{port}/metrics")
+        return server
+
+    def report(self):
+        counters, timers = self.snapshot()
+        for (name, labels), (count, seconds) in sorted(timers.items()):
+            print(
+                f"[{self.prefix}] {name}{format_labels(labels)}: {seconds:.2f}s over {count}"
+            )
+        for (name, labels), value in sorted(counters.items()):
+            print(f"[{self.prefix}] {name}{format_labels(labels)}: {value}")
+
+
+class MetricsGroup:
+    # Several registries exposed as one, daemon.py downloads and loads in one process.
+    def __init__(self, *metrics_list):
+        self.metrics_list = metrics_list
+
+    def render(self):
+        return "".join(metrics.render() for metrics in self.metrics_list)
+
+    def report(self):
+        for metrics in self.metrics_list:
+            metrics.report()
+
+    write = Metrics.write
+    serve = Metrics.serve
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument(
+        "--metrics-file",
+        help="write metrics in the prometheus text format to this file, e.g. for node_exporter's textfile collector",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve metrics in the prometheus text format on http://localhost:PORT/metrics while running",
+    )
+
+
+def start_metrics(metrics, arguments):
+    if arguments.metrics_port is not None:
+        metrics.serve(arguments.metrics_port)
+
+
+def finish_metrics(metrics, arguments):
+    metrics.report()
+    if arguments.metrics_file is not None:
+        metrics.write(arguments.metrics_file)
@@ -1,4 +1,5 @@
 import enum
+from datetime import datetime
 
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 
@@ -9,29 +10,77 @@ from sqlalchemy import (
     Numeric,
     SmallInteger,
     Integer,
+    BigInteger,
     Enum,
     Float,
+    Boolean,
     VARCHAR,
 )
 
-from sqlalchemy import event, DDL, orm
+from sqlalchemy import event, DDL, orm, text, inspect
 from geoalchemy2 import Geometry
 
+from archive import DEFAULT_USER_ID
+
+
+class Hypertable:
+    # TimescaleDB settings of a model, declared as `__hypertable__` on the model.
+    # https://docs.timescale.com/api/latest/compression/
+    # Chunks older than compress_after are compressed, chunks older than retain_for are
+    # dropped.
+    # Loading rows in to compressed chunks decompresses them first (see
+    # decompress_chunks), the compression policy compresses them again later.
+    # Rows are also hashed in to user_partitions space partitions by user_id, so that a
+    # chunk holds a few users' rows and queries of one user only scan that user's
+    # chunks.
+    def __init__(
+        self,
+        chunk_time_interval="1 week",
+        compress_after=None,
+        compress_segmentby="user_id",
+        compress_orderby="time_stamp DESC",
+        retain_for=None,
+        user_partitions=4,
+    ):
+        self.chunk_time_interval = chunk_time_interval
+        self.compress_after = compress_after
+        self.compress_segmentby = compress_segmentby
+        self.compress_orderby = compress_orderby
+        self.retain_for = retain_for
+        self.user_partitions = user_partitions
+
+
+def user_id_column():
+    # Last column of every table, part of the primary key. Parsers and rows.py only deal
+    # with the other columns, the loader adds the user of the batch.
+    return Column(
+        VARCHAR(32), nullable=False, primary_key=True, server_default=DEFAULT_USER_ID
+    )
+
+
+def get_data_columns(table):
+    return [column for column in table.columns if column.name != "user_id"]
+
 
 class HeartRate(Base):
     __tablename__ = "heart_rate"
+    # 86400 rows a day, compresses ~10x and grafana mostly reads the last few days raw.
+    __hypertable__ = Hypertable(compress_after="7 days")
     time_stamp = Column(TIMESTAMP, nullable=False, primary_key=True)
     heart_rate = Column(Integer)
+    user_id = user_id_column()
 
 
 class HeartRateSummary(Base):
     __tablename__ = "heart_rate_summary"
+    __hypertable__ = Hypertable()
     time_stamp = Column(TIMESTAMP, nullable=False, primary_key=True)
     resting_heart_rate = Column(Integer)
     out_of_range = Column(Integer)
     fat_burn = Column(Integer)
     cardio = Column(Integer)
     peak = Column(Integer)
+    user_id = user_id_column()
 
 
 # Fitbit improved up on its sleep level tagging on 2019.. So we have different tagging as time passes.
@@ -46,9 +95,11 @@ class SleepLevel(enum.Enum):
 
 class SleepClassicInfo(Base):
     __tablename__ = "sleep_classic_info"
+    __hypertable__ = Hypertable(compress_after="30 days")
     time_stamp = Column(TIMESTAMP, nullable=False, primary_key=True)
     sleep_level = Column(Enum(SleepLevel))
     sleep_level_value = Column(Integer, nullable=True)
+    user_id = user_id_column()
 
 
 class SleepStage(enum.Enum):
@@ -61,13 +112,38 @@ class SleepStage(enum.Enum):
 
 class SleepStagesInfo(Base):
     __tablename__ = "sleep_stages_info"
+    __hypertable__ = Hypertable(compress_after="30 days")
     time_stamp = Column(TIMESTAMP, nullable=False, primary_key=True)
     sleep_stage = Column(Enum(SleepStage))
     sleep_stage_value = Column(Integer, nullable=True)
+    user_id = user_id_column()
+
+
+# Resolution for fitbit's sleep metrics is 30 seconds right now.
+# It was 60 second when it started.
+FITBIT_SLEEP_CAPTURE_INTERVAL = 30
+
+
+# Sleep levels as reported by fitbit, one row per segment instead of one per
+# FITBIT_SLEEP_CAPTURE_INTERVAL.
+# Only one of sleep_level (classic) and sleep_stage (stages) is set.
+# The *_expanded views turn them back in to the shape of SleepClassicInfo and
+# SleepStagesInfo.
+class SleepSegment(Base):
+    __tablename__ = "sleep_segment"
+    __hypertable__ = Hypertable()
+    time_stamp = Column(TIMESTAMP, nullable=False, primary_key=True)
+    # Segments from "shortData" are short wakes that override the regular segments.
+    short_data = Column(Boolean, nullable=False, primary_key=True)
+    end_time_stamp = Column(TIMESTAMP, nullable=False)
+    sleep_level = Column(Enum(SleepLevel), nullable=True)
+    sleep_stage = Column(Enum(SleepStage), nullable=True)
+    user_id = user_id_column()
 
 
 class SleepSummary(Base):
     __tablename__ = "sleep_summary"
+    __hypertable__ = Hypertable()
     time_stamp = Column(TIMESTAMP, nullable=False, primary_key=True)
     num_sleeps = Column(Integer, nullable=True)
     total_sleep_time = Column(Integer, nullable=True)
@@ -78,11 +154,17 @@ class SleepSummary(Base):
     stage_light_duration = Column(Integer, nullable=True)
     stage_rem_duration = Column(Integer, nullable=True)
     stage_wake_duration = Column(Integer, nullable=True)
+    user_id = user_id_column()
 
 
 class Activity(Base):
     __tablename__ = "activity"
+    __hypertable__ = Hypertable(
+        compress_after="30 days", compress_segmentby="user_id, activity_id"
+    )
     time_stamp = Column(TIMESTAMP, nullable=False, primary_key=True)
+    # POINT(longitude latitude), rows loaded before the parser put them in this order
+    # have them swapped.
     co_ordinates = Column(
         Geometry(geometry_type="POINT", srid=4326)
     )  # https://postgis.net/workshops/postgis-intro/projection.html
@@ -92,6 +174,31 @@ class Activity(Base):
     # Not the most optimal but we can improve from here.
     # the activity_id will be stored for each and every instant of Activity for now.
     activity_id = Column(VARCHAR(15))
+    user_id = user_id_column()
+
+
+# One row per activity with a GPS track, the whole track as a line so that map panels
+# and "activities near X" queries read a row per activity instead of its points in
+# `activity`.
+# The line's M values are the epoch times of the track points, the bounding box is in
+# degrees.
+class ActivityTrack(Base):
+    __tablename__ = "activity_track"
+    __hypertable__ = Hypertable(chunk_time_interval="52 weeks")
+    time_stamp = Column(
+        TIMESTAMP, nullable=False, primary_key=True
+    )  # first track point
+    activity_id = Column(VARCHAR(15), nullable=False, primary_key=True)
+    end_time_stamp = Column(TIMESTAMP, nullable=False)  # last track point
+    # GiST indexed by geoalchemy2 (spatial_index), like co_ordinates.
+    track = Column(Geometry(geometry_type="LINESTRINGM", srid=4326, spatial_index=True))
+    points = Column(Integer)
+    distance = Column(Float)  # metres
+    min_longitude = Column(Float)
+    min_latitude = Column(Float)
+    max_longitude = Column(Float)
+    max_latitude = Column(Float)
+    user_id = user_id_column()
 
 
 class ActivityType(enum.Enum):
@@ -121,8 +228,10 @@ class ActivityType(enum.Enum):
     stairclimber = 21
     golf = 22
 
+
 class ActivitySummary(Base):
     __tablename__ = "activity_summary"
+    __hypertable__ = Hypertable()
     time_stamp = Column(TIMESTAMP, nullable=False, primary_key=True)
     activity_id = Column(VARCHAR(15))
     distance = Column(Integer)
@@ -130,10 +239,12 @@ class ActivitySummary(Base):
     duration = Column(Integer)
     calories = Column(Integer)
     activity_type = Column(Enum(ActivityType))
+    user_id = user_id_column()
 
 
 class DailyActivitySummary(Base):
     __tablename__ = "daily_activity_summary"
+    __hypertable__ = Hypertable()
     time_stamp = Column(TIMESTAMP, nullable=False, primary_key=True)
     steps = Column(Integer)
     floors = Column(Integer)
@@ -143,63 +254,349 @@ class DailyActivitySummary(Base):
     lightly_active_minutes = Column(Integer)
     fairly_active_minutes = Column(Integer)
     very_active_minutes = Column(Integer)
+    user_id = user_id_column()
 
 
-@event.listens_for(Activity.__table__, "after_create")
-def receive_after_create(target, connection, **kw):
-    DDL(
-        f"SELECT create_hypertable('{target}','time_stamp',chunk_time_interval := '1 week'::interval,if_not_exists := true);"
-    ).execute(connection)
-
-
-@event.listens_for(ActivitySummary.__table__, "after_create")
-def receive_after_create(target, connection, **kw):
-    DDL(
-        f"SELECT create_hypertable('{target}','time_stamp',chunk_time_interval := '1 week'::interval,if_not_exists := true);"
-    ).execute(connection)
-
-
-@event.listens_for(DailyActivitySummary.__table__, "after_create")
-def receive_after_create(target, connection, **kw):
-    DDL(
-        f"SELECT create_hypertable('{target}','time_stamp',chunk_time_interval := '1 week'::interval,if_not_exists := true);"
-    ).execute(connection)
-
-
-@event.listens_for(HeartRate.__table__, "after_create")
-def receive_after_create(target, connection, **kw):
-    DDL(
-        f"SELECT create_hypertable('{target}','time_stamp',chunk_time_interval := '1 week'::interval,if_not_exists := true);"
-    ).execute(connection)
-
-
-@event.listens_for(HeartRateSummary.__table__, "after_create")
-def receive_after_create(target, connection, **kw):
-    print(dir(DDL))
+# Per minute series of the intraday activity resources, a column per resource.
+# Columns of resources that weren't downloaded for a day are null.
+class ActivityIntraday(Base):
+    __tablename__ = "activity_intraday"
+    # 1440 rows a day.
+    __hypertable__ = Hypertable(compress_after="30 days")
+    time_stamp = Column(TIMESTAMP, nullable=False, primary_key=True)
+    steps = Column(Integer)
+    calories = Column(Float)
+    distance = Column(Float)  # metres
+    floors = Column(Integer)
+    elevation = Column(Float)  # metres
+    user_id = user_id_column()
+
+
+# Not a hypertable, one row per archived file that made it to the database.
+# Used by the sender to only parse day folders that are new or have changed since the
+# last run.
+class IngestedFile(Base):
+    __tablename__ = "ingested_file"
+    folder = Column(VARCHAR(10), nullable=False, primary_key=True)
+    file_name = Column(VARCHAR(64), nullable=False, primary_key=True)
+    size = Column(BigInteger)
+    checksum = Column(
+        VARCHAR(40)
+    )  # sha1 of the file contents, as recorded in the archive manifest
+    loaded_at = Column(TIMESTAMP)
+    user_id = user_id_column()
+
+
+def get_hypertables():
+    return [
+        (mapper.local_table, mapper.class_.__hypertable__)
+        for mapper in Base.registry.mappers
+        if hasattr(mapper.class_, "__hypertable__")
+    ]
+
+
+def apply_hypertable(connection, table, hypertable, retain_for=None):
+    # Idempotent, runs for new tables on create_all and for every table on sender.py
+    # --migrate.
     DDL(
-        f"SELECT create_hypertable('{target}','time_stamp',chunk_time_interval := '1 week'::interval,if_not_exists := true);"
+        f"SELECT create_hypertable('{table}','time_stamp',chunk_time_interval := '{hypertable.chunk_time_interval}'::interval,if_not_exists := true);"
     ).execute(connection)
-
-
-@event.listens_for(SleepSummary.__table__, "after_create")
-def receive_after_create(target, connection, **kw):
-    print(dir(DDL))
+    # Only changes the size of chunks created from now on.
     DDL(
-        f"SELECT create_hypertable('{target}','time_stamp',chunk_time_interval := '1 week'::interval,if_not_exists := true);"
+        f"SELECT set_chunk_time_interval('{table}', '{hypertable.chunk_time_interval}'::interval);"
     ).execute(connection)
-
-
-@event.listens_for(SleepClassicInfo.__table__, "after_create")
-def receive_after_create(target, connection, **kw):
-    print(dir(DDL))
+    if hypertable.user_partitions is not None:
+        # A dimension can only be added while the hypertable is empty, hypertables from
+        # before user_id stay partitioned by time alone.
+        is_empty = connection.execute(
+            text(f"SELECT NOT EXISTS (SELECT 1 FROM {table})")
+        ).scalar()
+        if is_empty:
+            DDL(
+                f"SELECT add_dimension('{table}', 'user_id', number_partitions => {hypertable.user_partitions}, if_not_exists => true);"
+            ).execute(connection)
+    if hypertable.compress_after is not None:
+        compression_enabled = connection.execute(
+            text(
+                "SELECT compression_enabled FROM timescaledb_information.hypertables WHERE hypertable_name = :table_name"
+            ),
+            {"table_name": table.name},
+        ).scalar()
+        # Compression settings can't be altered while there are compressed chunks.
+        if not compression_enabled:
+            compress_options = ["timescaledb.compress"]
+            if hypertable.compress_segmentby is not None:
+                compress_options.append(
+                    f"timescaledb.compress_segmentby = '{hypertable.compress_segmentby}'"
+                )
+            if hypertable.compress_orderby is not None:
+                compress_options.append(
+                    f"timescaledb.compress_orderby = '{hypertable.compress_orderby}'"
+                )
+            DDL(f"ALTER TABLE {table} SET ({', '.join(compress_options)});").execute(
+                connection
+            )
+        DDL(
+            f"SELECT add_compression_policy('{table}', INTERVAL '{hypertable.compress_after}', if_not_exists => true);"
+        ).execute(connection)
+    retain_for = retain_for or hypertable.retain_for
+    if retain_for is not None:
+        DDL(
+            f"SELECT add_retention_policy('{table}', INTERVAL '{retain_for}', if_not_exists => true);"
+        ).execute(connection)
+
+
+def apply_hypertables(connection, retention=None):
+    # retention: table name -> interval overriding Hypertable.retain_for,
+    # "timescale_retention" in config.json
+    retention = retention or {}
+    for table, hypertable in get_hypertables():
+        apply_hypertable(connection, table, hypertable, retention.get(table.name))
+
+
+def add_user_id(connection, table):
+    # Tables created before user_id, their rows belong to DEFAULT_USER_ID and user_id
+    # joins the primary key.
+    if "user_id" in [
+        column["name"] for column in inspect(connection).get_columns(table.name)
+    ]:
+        return
+    print(f"Adding user_id to {table.name}")
+    if (
+        "hypertable" in table.info
+        and table.info["hypertable"].compress_after is not None
+    ):
+        # Columns and constraints can't be changed while compression is enabled,
+        # apply_hypertable enables it again with user_id in compress_segmentby.
+        DDL(f"SELECT remove_compression_policy('{table}', if_exists => true);").execute(
+            connection
+        )
+        # Compression can't be turned off while there are compressed chunks.
+        decompress_chunks(connection, table, datetime.min, datetime.max)
+        DDL(f"ALTER TABLE {table} SET (timescaledb.compress = false);").execute(
+            connection
+        )
     DDL(
-        f"SELECT create_hypertable('{target}','time_stamp',chunk_time_interval := '1 week'::interval,if_not_exists := true);"
+        f"ALTER TABLE {table} ADD COLUMN user_id VARCHAR(32) NOT NULL DEFAULT '{DEFAULT_USER_ID}';"
     ).execute(connection)
+    primary_key = inspect(connection).get_pk_constraint(table.name)
+    DDL(f"ALTER TABLE {table} DROP CONSTRAINT {primary_key['name']};").execute(
+        connection
+    )
+    key_column_names = ", ".join(column.name for column in table.primary_key.columns)
+    DDL(f"ALTER TABLE {table} ADD PRIMARY KEY ({key_column_names});").execute(
+        connection
+    )
+    if table.name == SleepSegment.__tablename__:
+        create_sleep_segment_views(table, connection)
+
+
+def add_user_ids(connection):
+    # Runs before apply_hypertables on every sender.py run, a no op once every table has
+    # user_id.
+    for table in Base.metadata.sorted_tables:
+        if "user_id" in table.c:
+            add_user_id(connection, table)
+
+
+def decompress_chunks(connection, table, start, end):
+    # Compressed chunks can't be deleted from or upserted in to before timescale 2.11,
+    # the chunks overlapping start <= time_stamp < end are decompressed and the
+    # compression policy compresses them again later.
+    hypertable = table.info.get("hypertable")
+    if hypertable is None or hypertable.compress_after is None:
+        return
+    compressed_chunks = connection.execute(
+        text(
+            "SELECT concat(chunk_schema, '.', chunk_name) FROM timescaledb_information.chunks WHERE hypertable_name = :table_name AND is_compressed AND range_start < :end AND range_end > :start"
+        ),
+        {"table_name": table.name, "start": start, "end": end},
+    ).scalars()
+    for chunk in list(compressed_chunks):
+        # Another writer thread may have decompressed it since.
+        connection.execute(
+            text(
+                "SELECT decompress_chunk(CAST(:chunk AS regclass), if_compressed => true)"
+            ),
+            {"chunk": chunk},
+        )
+
+
+def delete_time_range(connection, table, start, end, user_id=None):
+    # Rows with start <= time_stamp < end of one user or of all users, for re-ingesting
+    # a date range (sender.py --force).
+    decompress_chunks(connection, table, start, end)
+    delete = table.delete().where(table.c.time_stamp >= start, table.c.time_stamp < end)
+    if user_id is not None:
+        delete = delete.where(table.c.user_id == user_id)
+    return connection.execute(delete).rowcount
 
 
-@event.listens_for(SleepStagesInfo.__table__, "after_create")
 def receive_after_create(target, connection, **kw):
-    print(dir(DDL))
-    DDL(
-        f"SELECT create_hypertable('{target}','time_stamp',chunk_time_interval := '1 week'::interval,if_not_exists := true);"
-    ).execute(connection)
+    apply_hypertable(connection, target, target.info["hypertable"])
+
+
+for table, hypertable in get_hypertables():
+    table.info["hypertable"] = hypertable
+    event.listen(table, "after_create", receive_after_create)
+
+
+class ContinuousAggregate:
+    # TimescaleDB continuous aggregate bucketing `source` by bucket_width, keeps the
+    # bucket in `time_stamp`.
+    # Kept up to date by a refresh policy and by the sender refreshing the days it just
+    # loaded.
+    # https://docs.timescale.com/api/latest/continuous-aggregates/
+    def __init__(
+        self,
+        name,
+        source,
+        bucket_width,
+        columns,
+        group_by=None,
+        start_offset="3 days",
+        schedule_interval="1 hour",
+    ):
+        self.name = name
+        self.source = source
+        self.bucket_width = bucket_width
+        self.columns = columns
+        self.group_by = group_by
+        self.start_offset = start_offset
+        self.schedule_interval = schedule_interval
+
+    def create(self, connection):
+        # Aggregates whose columns changed (created before user_id, or before a column
+        # was renamed) are dropped and built again from the source table.
+        view_columns = (
+            connection.execute(
+                text(
+                    "SELECT attname FROM pg_attribute WHERE attrelid = to_regclass(:name) AND attnum > 0"
+                ),
+                {"name": self.name},
+            )
+            .scalars()
+            .all()
+        )
+        bucket = f"time_bucket('{self.bucket_width}', time_stamp)"
+        group_by = [bucket, "user_id"] + ([self.group_by] if self.group_by else [])
+        select = [f"{bucket} AS time_stamp"] + group_by[1:] + self.columns
+        column_names = [column.split(" AS ")[-1] for column in select]
+        exists = len(view_columns) > 0
+        rebuild = exists and not set(column_names) <= set(view_columns)
+        if rebuild:
+            print(f"Rebuilding {self.name}")
+            DDL(f"DROP MATERIALIZED VIEW {self.name};").execute(connection)
+        DDL(f"""CREATE MATERIALIZED VIEW IF NOT EXISTS {self.name}
+            WITH (timescaledb.continuous) AS
+            SELECT {", ".join(select)}
+            FROM {self.source}
+            GROUP BY {", ".join(group_by)}
+            WITH NO DATA;""").execute(connection)
+        # The bucket in progress is left to real time aggregation.
+        DDL(
+            f"SELECT add_continuous_aggregate_policy('{self.name}', start_offset => INTERVAL '{self.start_offset}', end_offset => INTERVAL '{self.bucket_width}', schedule_interval => INTERVAL '{self.schedule_interval}', if_not_exists => true);"
+        ).execute(connection)
+        # The refresh policy and the sender only refresh recent days and the days they
+        # load, rows already in the source table are materialized once when the view is
+        # created.
+        if not exists or rebuild:
+            has_rows = connection.execute(
+                text(f"SELECT EXISTS (SELECT 1 FROM {self.source})")
+            ).scalar()
+            if has_rows:
+                print(f"Materializing {self.name}")
+                connection.execute(
+                    text(
+                        f"CALL refresh_continuous_aggregate('{self.name}', NULL, NULL)"
+                    )
+                )
+
+    def refresh(self, connection, start, end):
+        # Only buckets entirely within the window are refreshed, widened to whole
+        # buckets.
+        connection.execute(
+            text(
+                f"CALL refresh_continuous_aggregate('{self.name}', time_bucket('{self.bucket_width}', CAST(:start AS TIMESTAMP)), time_bucket('{self.bucket_width}', CAST(:end AS TIMESTAMP)) + INTERVAL '{self.bucket_width}')"
+            ),
+            {"start": start, "end": end},
+        )
+
+
+HEART_RATE_AGGREGATE_COLUMNS = [
+    "min(heart_rate) AS min_heart_rate",
+    "avg(heart_rate) AS avg_heart_rate",
+    "max(heart_rate) AS max_heart_rate",
+    "count(*) AS samples",
+]
+
+CONTINUOUS_AGGREGATES = [
+    ContinuousAggregate(
+        "heart_rate_1m",
+        HeartRate.__tablename__,
+        "1 minute",
+        HEART_RATE_AGGREGATE_COLUMNS,
+        start_offset="2 days",
+    ),
+    ContinuousAggregate(
+        "heart_rate_1h", HeartRate.__tablename__, "1 hour", HEART_RATE_AGGREGATE_COLUMNS
+    ),
+    ContinuousAggregate(
+        "heart_rate_1d",
+        HeartRate.__tablename__,
+        "1 day",
+        HEART_RATE_AGGREGATE_COLUMNS,
+        start_offset="7 days",
+        schedule_interval="1 day",
+    ),
+    # distance is cumulative within an activity, so grouped by it. altitude is absolute,
+    # altitude_range is its spread within the bucket, not the elevation gained.
+    ContinuousAggregate(
+        "activity_1h",
+        Activity.__tablename__,
+        "1 hour",
+        [
+            "max(distance) - min(distance) AS distance",
+            "max(altitude) - min(altitude) AS altitude_range",
+            "avg(heart_rate) AS avg_heart_rate",
+            "count(*) AS samples",
+        ],
+        group_by="activity_id",
+    ),
+]
+
+
+def create_continuous_aggregates(engine):
+    # Continuous aggregates can't be created or refreshed inside a transaction.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for aggregate in CONTINUOUS_AGGREGATES:
+            aggregate.create(connection)
+
+
+def refresh_continuous_aggregates(engine, windows):
+    # windows: source table name -> [(start, end)] of time stamps that were loaded.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for aggregate in CONTINUOUS_AGGREGATES:
+            for start, end in windows.get(aggregate.source, []):
+                aggregate.refresh(connection, start, end)
+
+
+@event.listens_for(SleepSegment.__table__, "after_create")
+def create_sleep_segment_views(target, connection, **kw):
+    for view_name, level_column in [
+        ("sleep_classic_info_expanded", "sleep_level"),
+        ("sleep_stages_info_expanded", "sleep_stage"),
+    ]:
+        DDL(f"""CREATE OR REPLACE VIEW {view_name} AS
+            SELECT DISTINCT ON (user_id, instant) instant AS time_stamp, {level_column}, {level_column}_value, user_id
+            FROM (
+                SELECT
+                    generate_series(time_stamp, end_time_stamp - interval '1 microsecond', interval '{FITBIT_SLEEP_CAPTURE_INTERVAL} seconds') AS instant,
+                    user_id,
+                    short_data,
+                    {level_column},
+                    array_position(enum_range(NULL::{level_column.replace("_", "")}), {level_column}) - 1 AS {level_column}_value
+                FROM {target}
+                WHERE {level_column} IS NOT NULL
+            ) AS instants
+            ORDER BY user_id, instant, short_data DESC;""").execute(connection)
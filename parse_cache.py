@@ -0,0 +1,64 @@
+import hashlib
+import json
+import pickle
+from os import makedirs, remove, replace, utime, walk
+from os.path import getsize, getmtime, isfile, join
+
+# Parsed column batches of a day and data type, so that reloading a day (--force, a
+# rebuilt database, a schema change) doesn't parse the same json and tcx files again.
+# Entries are keyed by the day, the checksums of the source files and the parser
+# version, they are never stale.
+# Least recently used entries are removed once the cache is bigger than its size limit.
+CACHE_FILE_SUFFIX = ".pickle"
+
+
+def get_cache_key(*parts):
+    return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+
+class ParseCache:
+    def __init__(self, cache_folder, max_bytes):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+
+    def get_path(self, key):
+        return join(self.cache_folder, key[:2], key + CACHE_FILE_SUFFIX)
+
+    def load(self, key):
+        path = self.get_path(key)
+        if not isfile(path):
+            return None
+        with open(path, "rb") as cache_file_handler:
+            batches = pickle.load(cache_file_handler)
+        # The modified time doubles as the last access time for eviction.
+        utime(path)
+        return batches
+
+    def store(self, key, batches):
+        # Written by parser processes in parallel, an entry only shows up once it's
+        # complete.
+        # Protocol 5 writes the array columns as raw buffers, loading them is a copy
+        # from disk.
+        path = self.get_path(key)
+        makedirs(join(self.cache_folder, key[:2]), exist_ok=True)
+        with open(path + ".tmp", "wb") as cache_file_handler:
+            pickle.dump(batches, cache_file_handler, protocol=5)
+        replace(path + ".tmp", path)
+
+    def evict(self):
+        # Runs once per sender.py run from the main process.
+        entries = []
+        for folder_path, _, file_names in walk(self.cache_folder):
+            for file_name in file_names:
+                if file_name.endswith(CACHE_FILE_SUFFIX):
+                    path = join(folder_path, file_name)
+                    entries.append((getmtime(path), getsize(path), path))
+        total_bytes = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            remove(path)
+            total_bytes -= size
+            evicted += 1
+        return evicted, total_bytes
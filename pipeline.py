@@ -0,0 +1,76 @@
+import threading
+from collections import deque
+from queue import Full, Queue
+
+# Helpers to run the sender's parse and load stages concurrently with bounded memory.
+
+END_OF_ITEMS = object()
+
+
+def bounded_map(executor, function, *iterables, window):
+    # Like executor.map, but only `window` items are submitted ahead of the one being
+    # consumed, so results don't pile up when the consumer is slower than the executor.
+    futures = deque()
+    try:
+        for arguments in zip(*iterables):
+            futures.append(executor.submit(function, *arguments))
+            if len(futures) >= window:
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
+    finally:
+        # A consumer that stops early doesn't wait for the items it will never get on
+        # executor shutdown.
+        for future in futures:
+            future.cancel()
+
+
+class ProducerError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def iter_in_background(items, maxsize):
+    # Iterates `items` in a background thread and yields them in the calling thread.
+    # The queue between the two holds at most `maxsize` items, the producer blocks when
+    # it is full.
+    # Once the consumer is done, failed or closed the generator early, the producer
+    # stops iterating `items` and closes it, so that a process pool `items` runs in is
+    # shut down instead of blocking on a full queue.
+    item_queue = Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                item_queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    break
+        except BaseException as exception:
+            put(ProducerError(exception))
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+            put(END_OF_ITEMS)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = item_queue.get()
+            if item is END_OF_ITEMS:
+                return
+            if isinstance(item, ProducerError):
+                raise item.exception
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
@@ -0,0 +1,45 @@
+from collections import namedtuple
+
+from models import (
+    HeartRate,
+    HeartRateSummary,
+    SleepSummary,
+    SleepStagesInfo,
+    SleepClassicInfo,
+    SleepSegment,
+    DailyActivitySummary,
+    ActivitySummary,
+    Activity,
+    ActivityIntraday,
+    ActivityTrack,
+    get_data_columns,
+)
+
+# Plain tuples for the parsers to emit instead of ORM instances, no instrumentation
+# state or identity map.
+# Fields follow `Model.__table__.columns` without user_id, so a row is what the loader
+# copies in to the table as is.
+# TIMESTAMP fields hold epoch seconds of the wall clock time, see loader.py.
+
+
+def row_type(model):
+    column_names = [column.name for column in get_data_columns(model.__table__)]
+    row_class = namedtuple(
+        model.__name__ + "Row", column_names, defaults=[None] * len(column_names)
+    )
+    # Only the loader looks at this, to find the table a row belongs to.
+    row_class.__table__ = model.__table__
+    return row_class
+
+
+HeartRateRow = row_type(HeartRate)
+HeartRateSummaryRow = row_type(HeartRateSummary)
+SleepClassicInfoRow = row_type(SleepClassicInfo)
+SleepStagesInfoRow = row_type(SleepStagesInfo)
+SleepSegmentRow = row_type(SleepSegment)
+SleepSummaryRow = row_type(SleepSummary)
+ActivityRow = row_type(Activity)
+ActivitySummaryRow = row_type(ActivitySummary)
+DailyActivitySummaryRow = row_type(DailyActivitySummary)
+ActivityIntradayRow = row_type(ActivityIntraday)
+ActivityTrackRow = row_type(ActivityTrack)
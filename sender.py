@@ -1,11 +1,19 @@
 import sys
 import json
-from os import listdir
-from os.path import join, isdir, isfile, sep
+import argparse
+import calendar
+import re
+from array import array
+from bisect import bisect_left
+from functools import partial
+from time import sleep
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from os.path import join, sep, basename
 import xml.etree.ElementTree as ET
 
 import arrow
-from sqlalchemy import create_engine, func
+from sqlalchemy import create_engine, func, inspect
+from sqlalchemy.exc import OperationalError, InterfaceError
 from sqlalchemy.orm import relationship, backref, sessionmaker
 from models import (
     Base,
@@ -16,20 +24,48 @@ from models import (
     SleepClassicInfo,
     SleepLevel,
     SleepStage,
+    SleepSegment,
+    FITBIT_SLEEP_CAPTURE_INTERVAL,
     DailyActivitySummary,
     ActivityType,
     ActivitySummary,
     Activity,
+    ActivityIntraday,
+    ActivityTrack,
+    IngestedFile,
+    apply_hypertables,
+    create_continuous_aggregates,
+    refresh_continuous_aggregates,
+    delete_time_range,
+    add_user_ids,
 )
-
-TCX_FILE_URL = "https://api.fitbit.com/1/user/-/activities/{}.tcx"
-FILE_URL_MAPPING = {
-    "intra-day-heart-rate-series.json": "https://api.fitbit.com/1/user/-/activities/heart/date/{}/1d/1sec.json",
-    "activities.json": "https://api.fitbit.com/1/user/-/activities/date/{}.json",
-    "sleep.json": "https://api.fitbit.com/1.2/user/-/sleep/date/{}.json",
-}
-
-ARCHIVAL_FILE_LISTING = FILE_URL_MAPPING.keys()
+from loader import LOADERS, LoadStats, ColumnBatch, batches_from_rows, iter_batches
+from rows import (
+    HeartRateSummaryRow,
+    SleepSegmentRow,
+    SleepSummaryRow,
+    ActivityRow,
+    ActivityTrackRow,
+    ActivitySummaryRow,
+    DailyActivitySummaryRow,
+)
+from pipeline import bounded_map, iter_in_background
+from archive import (
+    DATA_TYPES,
+    Manifest,
+    open_archived_file,
+    get_intraday_file_name,
+    INTRADAY_RESOURCES,
+    get_file_type,
+    get_data_type,
+    add_selection_arguments,
+    is_in_date_range,
+    get_users,
+    select_users,
+)
+from parse_cache import ParseCache, get_cache_key
+from geometry import point_ewkb, read_point_ewkb, linestring_m_ewkb
+from metrics import Metrics, add_metrics_arguments, start_metrics, finish_metrics
 
 with open("config.json") as config_file_handler:
     config = json.load(config_file_handler)
@@ -40,11 +76,26 @@ with open("config.json") as config_file_handler:
     timescale_database = config["timescale_database"]
     timescale_ssl_string = config["timescale_ssl_string"]
     start_timestamp = arrow.get(config["start_date"])
-    fitbit_data_archival_folder = config["fitbit_data_archival_folder"]
+    # Each user's archive, see archive.get_users.
+    users = get_users(config)
+    # table name -> interval, e.g. {"heart_rate": "5 years"}
+    timescale_retention = config.get("timescale_retention", {})
+    # null disables the parse cache.
+    parse_cache_folder = config.get("parse_cache_folder", None)
+    parse_cache_size_gb = config.get("parse_cache_size_gb", 10)
 
 POSTGRES_STR = f"postgresql://{timescale_user}:{timescale_password}@{timescale_host}:{timescale_port}/{timescale_database}?sslmode={timescale_ssl_string}"
 
-engine = create_engine(POSTGRES_STR, echo=True)
+# --echo-sql logs every statement, it slows down large loads.
+# The pool grows with --writers, every writer thread holds a connection while it loads a
+# transaction.
+engine = create_engine(POSTGRES_STR, echo=False, max_overflow=-1)
+
+metrics = Metrics("fitbit_sender")
+
+parse_cache = None
+if parse_cache_folder is not None:
+    parse_cache = ParseCache(parse_cache_folder, parse_cache_size_gb * 2**30)
 
 
 def return_formatted_string(arrow_object):
@@ -68,9 +119,8 @@ def parse_rate_zone_info(heart_rate_zone_summary):
 
 def parse_heart_rate_data(folder_path):
     file_path = join(folder_path, "intra-day-heart-rate-series.json")
-    assert isfile(file_path)
     parsed_objects = []
-    with open(file_path, "r") as intra_day_heart_rate_series_file_handler:
+    with open_archived_file(file_path) as intra_day_heart_rate_series_file_handler:
         intra_day_heart_rate_series_obj = json.load(
             intra_day_heart_rate_series_file_handler
         )
@@ -103,9 +153,55 @@ def parse_heart_rate_data(folder_path):
     return parsed_objects
 
 
-# Resolution for fitbit's sleep metrics is 30 seconds right now.
-# It was 60 second when it started.
-FITBIT_SLEEP_CAPTURE_INTERVAL = 30
+def day_epoch(date):
+    # Folder names, fitbit dates and time stamps are wall clock times stored as UTC.
+    return calendar.timegm((int(date[0:4]), int(date[5:7]), int(date[8:10]), 0, 0, 0))
+
+
+def parse_heart_rate_columns(folder_path):
+    # Same rows as `parse_heart_rate_data`, without an arrow parse and an ORM object per
+    # sample.
+    file_path = join(folder_path, "intra-day-heart-rate-series.json")
+    with open_archived_file(file_path) as intra_day_heart_rate_series_file_handler:
+        intra_day_heart_rate_series_obj = json.load(
+            intra_day_heart_rate_series_file_handler
+        )
+    heart_rate_summary = intra_day_heart_rate_series_obj["activities-heart"][0]
+    date = heart_rate_summary["dateTime"]
+    date_epoch = day_epoch(date)
+    zone_info = parse_rate_zone_info(heart_rate_summary["value"]["heartRateZones"])
+    resting_heart_rate = heart_rate_summary["value"].get("restingHeartRate", -1)
+    summary_batch = ColumnBatch.from_rows(
+        HeartRateSummary.__table__,
+        [
+            HeartRateSummaryRow(
+                time_stamp=date_epoch,
+                resting_heart_rate=resting_heart_rate,
+                out_of_range=zone_info["out_of_range"],
+                fat_burn=zone_info["fat_burn"],
+                cardio=zone_info["cardio"],
+                peak=zone_info["peak"],
+            )
+        ],
+    )
+    yield summary_batch
+    yield parse_heart_rate_dataset(
+        date_epoch,
+        intra_day_heart_rate_series_obj["activities-heart-intraday"]["dataset"],
+    )
+
+
+def parse_heart_rate_dataset(date_epoch, day_series):
+    # Samples of a day's series or of a time window within the day (daemon.py).
+    time_stamps = array("q")
+    heart_rates = array("i")
+    for series_obj in day_series:
+        time = series_obj["time"]  # HH:mm:ss
+        time_stamps.append(
+            date_epoch + int(time[0:2]) * 3600 + int(time[3:5]) * 60 + int(time[6:8])
+        )
+        heart_rates.append(series_obj["value"])
+    return ColumnBatch(HeartRate.__tablename__, [time_stamps, heart_rates])
 
 
 def parse_classic_sleep_info(sleep_info):
@@ -143,12 +239,12 @@ def parse_stages_sleep_info(sleep_info):
         level = instant.get("level")
         for offset_seconds in range(0, duration, FITBIT_SLEEP_CAPTURE_INTERVAL):
             current_instant = instant_start.shift(seconds=offset_seconds)
-            time_stamp_indexed_sleep_dict[
-                current_instant.timestamp()
-            ] = SleepStagesInfo(
-                time_stamp=current_instant.datetime,
-                sleep_stage=SleepStage[level],
-                sleep_stage_value=SleepStage[level].value,
+            time_stamp_indexed_sleep_dict[current_instant.timestamp()] = (
+                SleepStagesInfo(
+                    time_stamp=current_instant.datetime,
+                    sleep_stage=SleepStage[level],
+                    sleep_stage_value=SleepStage[level].value,
+                )
             )
 
     short_data = levels.get("shortData", None)
@@ -159,82 +255,166 @@ def parse_stages_sleep_info(sleep_info):
         assert level == "wake"
         for offset_seconds in range(0, duration, FITBIT_SLEEP_CAPTURE_INTERVAL):
             current_instant = instant_start.shift(seconds=offset_seconds)
-            time_stamp_indexed_sleep_dict[
-                current_instant.timestamp()
-            ] = SleepStagesInfo(
-                time_stamp=current_instant.datetime,
-                sleep_stage=SleepStage[level],
-                sleep_stage_value=SleepStage[level].value,
+            time_stamp_indexed_sleep_dict[current_instant.timestamp()] = (
+                SleepStagesInfo(
+                    time_stamp=current_instant.datetime,
+                    sleep_stage=SleepStage[level],
+                    sleep_stage_value=SleepStage[level].value,
+                )
             )
     return list(time_stamp_indexed_sleep_dict.values())
 
 
-def parse_detailed_sleep_info(sleep_info):
-    parsed_sleep_info = []
+WALL_CLOCK_TIME_STAMP = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(\.\d+)?"
+)
+
+
+def wall_clock_epoch(time_stamp_string):
+    # Same instant as arrow.get(time_stamp_string).timestamp() for time stamps without
+    # an offset.
+    year, month, day, hour, minute, second, fraction = WALL_CLOCK_TIME_STAMP.match(
+        time_stamp_string
+    ).groups()
+    epoch = calendar.timegm(
+        (int(year), int(month), int(day), int(hour), int(minute), int(second))
+    )
+    if fraction is not None and float(fraction) != 0:
+        return epoch + float(fraction)
+    return epoch
+
+
+def overlay_sleep_segment(time_stamps, levels, start, duration, level):
+    instants = range(start, start + duration, FITBIT_SLEEP_CAPTURE_INTERVAL)
+    if len(time_stamps) == 0 or start > time_stamps[-1]:
+        time_stamps.extend(instants)
+        levels.extend([level] * len(instants))
+        return
+    # Overlapping segment ("shortData" wakes), later segments win like they did in the
+    # time stamp indexed dict.
+    for instant in instants:
+        index = bisect_left(time_stamps, instant)
+        if index < len(time_stamps) and time_stamps[index] == instant:
+            levels[index] = level
+        else:
+            time_stamps.insert(index, instant)
+            levels.insert(index, level)
+
+
+def expand_sleep_levels(sleep_info, model, level_enum):
+    # Same rows as parse_classic_sleep_info / parse_stages_sleep_info, sorted by time
+    # stamp.
+    time_stamps = array("q")
+    levels = []
+    sleep_levels = sleep_info.get("levels", None)
+    for segments_key in ["data", "shortData"]:
+        for segment in sleep_levels.get(segments_key, None) or []:
+            start = wall_clock_epoch(segment.get("dateTime"))
+            # Sleep levels are reported on whole seconds.
+            assert isinstance(start, int)
+            overlay_sleep_segment(
+                time_stamps,
+                levels,
+                start,
+                segment.get("seconds"),
+                level_enum[segment.get("level")],
+            )
+    return ColumnBatch(
+        model.__tablename__, [time_stamps, levels, [level.value for level in levels]]
+    )
+
+
+def parse_sleep_segments(sleep_info):
+    rows = []
+    sleep_levels = sleep_info.get("levels", None)
+    for short_data, segments_key in [(False, "data"), (True, "shortData")]:
+        for segment in sleep_levels.get(segments_key, None) or []:
+            start = wall_clock_epoch(segment.get("dateTime"))
+            level = segment.get("level")
+            if sleep_info["type"] == "classic":
+                sleep_level, sleep_stage = SleepLevel[level], None
+            else:
+                sleep_level, sleep_stage = None, SleepStage[level]
+            rows.append(
+                SleepSegmentRow(
+                    time_stamp=start,
+                    short_data=short_data,
+                    end_time_stamp=start + segment.get("seconds"),
+                    sleep_level=sleep_level,
+                    sleep_stage=sleep_stage,
+                )
+            )
+    return ColumnBatch.from_rows(SleepSegment.__table__, rows)
+
+
+# points -> one row per FITBIT_SLEEP_CAPTURE_INTERVAL, segments -> one row per sleep
+# level segment.
+SLEEP_STORAGE_MODES = ["points", "segments"]
+
+
+def parse_detailed_sleep_info(sleep_info, sleep_storage="points"):
     assert sleep_info["type"] in ["classic", "stages"]
+    if sleep_storage == "segments":
+        return [parse_sleep_segments(sleep_info)]
     if sleep_info["type"] == "classic":
-        parsed_sleep_info.extend(parse_classic_sleep_info(sleep_info))
+        # The classic sleep info doesn't seem to have "shortData"
+        assert sleep_info["levels"].get("shortData", None) is None
+        return [expand_sleep_levels(sleep_info, SleepClassicInfo, SleepLevel)]
     elif sleep_info["type"] == "stages":
-        parsed_sleep_info.extend(parse_stages_sleep_info(sleep_info))
+        return [expand_sleep_levels(sleep_info, SleepStagesInfo, SleepStage)]
     else:
         # Currently we only know about classic and stages.
         print("Found an unexpected sleep type")
         sys.exit(-1)
-    return parsed_sleep_info
 
 
-def parse_sleep_zone_info(folder_path):
-    short_data_levels = set()
+def parse_sleep_zone_info(folder_path, sleep_storage="points"):
     file_path = join(folder_path, "sleep.json")
-    assert isfile(file_path)
-    parsed_objects = []
-    with open(file_path, "r") as sleep_file_handler:
+    with open_archived_file(file_path) as sleep_file_handler:
         sleep_obj = json.load(sleep_file_handler)
-        sleep_data = sleep_obj["sleep"]
-        sleep_record_dates = set()
-        # sleep is an array here. Need to parse all the sleeps per day.
-        for each_sleep in sleep_data:
-            sleep_record_dates.add(each_sleep.get("dateOfSleep"))
-            parsed_objects.extend(parse_detailed_sleep_info(each_sleep))
-        # sleep_record_dates can be either of length ->
-        # 0 -> No sleeps are recorded on a day
-        # 1 -> Sleeps are recorded and all of them belong to same day. This is due to our assumption of downloading only single day's data at a time.
-        assert len(sleep_record_dates) < 2
-        # Don't create a sleep summary if no sleep are recorded.
-        if len(sleep_record_dates) == 1:
-            # Moving summary to end as the date needs to be parsed from individual sleep records
-            sleep_summary = sleep_obj.get("summary", None)
-            if sleep_summary is not None:
-                total_sleep_time = sleep_summary.get("totalMinutesAsleep", None)
-                total_time_in_bed = sleep_summary.get("totalTimeInBed", None)
-                num_sleeps = sleep_summary.get("totalSleepRecords", None)
-                # https://stackoverflow.com/a/59841/8730225
-                time_stamp = arrow.get(next(iter(sleep_record_dates)))
-                sleep_summary_data_obj = SleepSummary(
-                    time_stamp=time_stamp.datetime,
+    yield from parse_sleep_day(sleep_obj, sleep_storage)
+
+
+def parse_sleep_day(sleep_obj, sleep_storage="points"):
+    # A day of the sleep endpoint, from the archive or polled by daemon.py.
+    parsed_rows = []
+    sleep_data = sleep_obj["sleep"]
+    sleep_record_dates = set()
+    # sleep is an array here. Need to parse all the sleeps per day.
+    for each_sleep in sleep_data:
+        sleep_record_dates.add(each_sleep.get("dateOfSleep"))
+        yield from parse_detailed_sleep_info(each_sleep, sleep_storage)
+    # sleep_record_dates can be either of length ->
+    # 0 -> No sleeps are recorded on a day
+    # 1 -> Sleeps are recorded and all of them belong to same day. This is due to our assumption of downloading only single day's data at a time.
+    assert len(sleep_record_dates) < 2
+    # Don't create a sleep summary if no sleep are recorded.
+    if len(sleep_record_dates) == 1:
+        # Moving summary to end as the date needs to be parsed from individual sleep records
+        sleep_summary = sleep_obj.get("summary", None)
+        if sleep_summary is not None:
+            total_sleep_time = sleep_summary.get("totalMinutesAsleep", None)
+            total_time_in_bed = sleep_summary.get("totalTimeInBed", None)
+            num_sleeps = sleep_summary.get("totalSleepRecords", None)
+            # https://stackoverflow.com/a/59841/8730225
+            time_stamp = day_epoch(next(iter(sleep_record_dates)))
+            sleep_stages_summary = sleep_summary.get("stages", None) or {}
+            parsed_rows.append(
+                SleepSummaryRow(
+                    time_stamp=time_stamp,
                     num_sleeps=num_sleeps,
                     total_time_in_bed=total_time_in_bed,
                     total_sleep_time=total_sleep_time,
+                    stage_deep_duration=sleep_stages_summary.get("deep", None),
+                    stage_light_duration=sleep_stages_summary.get("light", None),
+                    stage_rem_duration=sleep_stages_summary.get("rem", None),
+                    stage_wake_duration=sleep_stages_summary.get("wake", None),
                 )
-                sleep_stages_summary = sleep_summary.get("stages", None)
-                if sleep_stages_summary is not None:
-                    sleep_summary_data_obj.stage_deep_duration = (
-                        sleep_stages_summary.get("deep", None)
-                    )
-                    sleep_summary_data_obj.stage_light_duration = (
-                        sleep_stages_summary.get("light", None)
-                    )
-                    sleep_summary_data_obj.stage_rem_duration = (
-                        sleep_stages_summary.get("rem", None)
-                    )
-                    sleep_summary_data_obj.stage_wake_duration = (
-                        sleep_stages_summary.get("wake", None)
-                    )
-                parsed_objects.append(sleep_summary_data_obj)
-    return parsed_objects
+            )
+    yield from batches_from_rows(parsed_rows)
 
 
-def parse_daily_activity_summary(activity, date):
+def parse_daily_activity_summary(activity, date_epoch):
     number_of_activites = len(activity["activities"])
     summary = activity["summary"]
     steps = summary["steps"]
@@ -244,8 +424,8 @@ def parse_daily_activity_summary(activity, date):
     very_active_minutes = summary["veryActiveMinutes"]
     elevation = summary["elevation"]
     floors = summary["floors"]
-    return DailyActivitySummary(
-        time_stamp=date.datetime,
+    return DailyActivitySummaryRow(
+        time_stamp=date_epoch,
         steps=steps,
         floors=floors,
         elevation=elevation,
@@ -273,8 +453,8 @@ def parse_activity_summaries(activities):
             activity["activityParentName"].replace(" ", "_").lower()
         ]
         parsed_activity_summaries.append(
-            ActivitySummary(
-                time_stamp=time_stamp.datetime,
+            ActivitySummaryRow(
+                time_stamp=time_stamp.timestamp(),
                 activity_id=activity_id,
                 distance=distance,
                 steps=steps,
@@ -300,20 +480,17 @@ def parse_heart_beat(indexed_track_point_data):
         return None
 
 
-def parse_lat_long(indexed_track_point_data):
-    if "Position" in indexed_track_point_data:
-        return (
-            indexed_track_point_data["Position"][0].text,
-            indexed_track_point_data["Position"][1].text,
-        )
-    else:
-        return (None, None)
+def parse_position(position):
+    # <Position><LatitudeDegrees/><LongitudeDegrees/></Position>
+    latitude, longitude = float(position[0].text), float(position[1].text)
+    return point_ewkb(longitude, latitude)
 
 
 def parse_activity_details(activity_log_id, folder_path):
     seconds_dedup_cache = {}
     xml_file = join(folder_path, str(activity_log_id) + ".xml")
-    activity_root = ET.parse(xml_file).getroot()
+    with open_archived_file(xml_file) as xml_file_handler:
+        activity_root = ET.parse(xml_file_handler).getroot()
     # TrainingCenterDatabase -> Activities -> Activity
     activity_content = activity_root[0][0]
     for elem in activity_content:
@@ -339,7 +516,11 @@ def parse_activity_details(activity_log_id, folder_path):
                         time_stamp = arrow.get(
                             ignore_tz_string(indexed_track_point_data["Time"].text)
                         )
-                        latitude, longitude = parse_lat_long(indexed_track_point_data)
+                        co_ordinates = None
+                        if "Position" in indexed_track_point_data:
+                            co_ordinates = parse_position(
+                                indexed_track_point_data["Position"]
+                            )
                         altitude = indexed_track_point_data["AltitudeMeters"].text
                         distance = indexed_track_point_data["DistanceMeters"].text
                         heart_rate = parse_heart_beat(indexed_track_point_data)
@@ -350,7 +531,7 @@ def parse_activity_details(activity_log_id, folder_path):
 
                         seconds_dedup_cache[epoch_sec] = Activity(
                             time_stamp=time_stamp.datetime,
-                            co_ordinates=f"SRID=4326;POINT({latitude} {longitude})",
+                            co_ordinates=co_ordinates,
                             altitude=altitude,
                             distance=distance,
                             heart_rate=heart_rate,
@@ -359,100 +540,859 @@ def parse_activity_details(activity_log_id, folder_path):
     return seconds_dedup_cache.values()
 
 
+TCX_NAMESPACE = "{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}"
+TCX_LAP_TAG = TCX_NAMESPACE + "Lap"
+TCX_TRACK_TAG = TCX_NAMESPACE + "Track"
+TCX_TRACK_POINT_TAG = TCX_NAMESPACE + "Trackpoint"
+TCX_TIME_TAG = TCX_NAMESPACE + "Time"
+TCX_POSITION_TAG = TCX_NAMESPACE + "Position"
+TCX_ALTITUDE_TAG = TCX_NAMESPACE + "AltitudeMeters"
+TCX_DISTANCE_TAG = TCX_NAMESPACE + "DistanceMeters"
+TCX_HEART_RATE_TAG = TCX_NAMESPACE + "HeartRateBpm"
+
+
+def parse_track_point(track_point, activity_id):
+    time_stamp = co_ordinates = altitude = distance = heart_rate = None
+    for track_point_sub_tag in track_point:
+        tag = track_point_sub_tag.tag
+        if tag == TCX_TIME_TAG:
+            # The offset is ignored like ignore_tz_string does, time stamps are stored
+            # as wall clock time.
+            time_stamp = wall_clock_epoch(track_point_sub_tag.text)
+        elif tag == TCX_POSITION_TAG:
+            co_ordinates = parse_position(track_point_sub_tag)
+        elif tag == TCX_ALTITUDE_TAG:
+            altitude = track_point_sub_tag.text
+        elif tag == TCX_DISTANCE_TAG:
+            distance = track_point_sub_tag.text
+        elif tag == TCX_HEART_RATE_TAG:
+            heart_rate = track_point_sub_tag[0].text
+    return ActivityRow(
+        time_stamp, co_ordinates, altitude, distance, heart_rate, activity_id
+    )
+
+
+def iter_track_points(xml_file):
+    # Trackpoint elements of the laps' tracks, dropped from the tree once the consumer
+    # moves on so memory doesn't grow with the file.
+    in_lap = False
+    track = None
+    with open_archived_file(xml_file) as xml_file_handler:
+        for event, element in ET.iterparse(xml_file_handler, events=("start", "end")):
+            tag = element.tag
+            if event == "start":
+                if tag == TCX_LAP_TAG:
+                    in_lap = True
+                elif tag == TCX_TRACK_TAG and in_lap:
+                    track = element
+                continue
+            if tag == TCX_TRACK_POINT_TAG and track is not None:
+                yield element
+                track.remove(element)
+            elif tag == TCX_TRACK_TAG:
+                track = None
+            elif tag == TCX_LAP_TAG:
+                in_lap = False
+                element.clear()
+
+
+def iter_activity_details(activity_log_id, folder_path):
+    # Streaming version of parse_activity_details, yields Activity rows while the TCX
+    # file is read.
+    # Like its seconds_dedup_cache the last track point of a second wins, wherever the
+    # repeat is. A first pass over the times finds the last track point of every
+    # second, the second pass only yields those. A second repeated out of order is
+    # yielded at its last track point rather than its first.
+    xml_file = join(folder_path, str(activity_log_id) + ".xml")
+    activity_id = str(activity_log_id)
+    last_track_points = {}
+    for index, track_point in enumerate(iter_track_points(xml_file)):
+        time_element = track_point.find(TCX_TIME_TAG)
+        # rounding of milli-seconds component.
+        last_track_points[int(wall_clock_epoch(time_element.text))] = index
+    for index, track_point in enumerate(iter_track_points(xml_file)):
+        row = parse_track_point(track_point, activity_id)
+        if last_track_points[int(row[0])] == index:
+            yield row
+
+
+class TrackBuilder:
+    # Collects the positions of an activity's rows on their way to the loader, for its
+    # activity_track row.
+    def __init__(self, activity_id):
+        self.activity_id = activity_id
+        self.longitudes = array("d")
+        self.latitudes = array("d")
+        self.time_stamps = array("d")
+        self.distance = None
+
+    def add_rows(self, rows):
+        for row in rows:
+            if row.co_ordinates is not None:
+                longitude, latitude = read_point_ewkb(row.co_ordinates)
+                self.longitudes.append(longitude)
+                self.latitudes.append(latitude)
+                self.time_stamps.append(row.time_stamp)
+            if row.distance is not None:
+                # Cumulative over the activity.
+                self.distance = max(self.distance or 0.0, float(row.distance))
+            yield row
+
+    def get_row(self):
+        # A line needs two points, activities without GPS (treadmill, ...) have no
+        # track.
+        if len(self.longitudes) < 2:
+            return None
+        return ActivityTrackRow(
+            time_stamp=self.time_stamps[0],
+            activity_id=self.activity_id,
+            end_time_stamp=self.time_stamps[-1],
+            track=linestring_m_ewkb(self.longitudes, self.latitudes, self.time_stamps),
+            points=len(self.longitudes),
+            distance=self.distance,
+            min_longitude=min(self.longitudes),
+            min_latitude=min(self.latitudes),
+            max_longitude=max(self.longitudes),
+            max_latitude=max(self.latitudes),
+        )
+
+
 def parse_activity_info(folder_path):
     file_path = join(folder_path, "activities.json")
-    assert isfile(file_path)
-    parsed_objects = []
-    with open(file_path, "r") as activity_file_handler:
+    parsed_rows = []
+    with open_archived_file(file_path) as activity_file_handler:
         activity_obj = json.load(activity_file_handler)
         current_date = folder_path.split(sep)[-1]
-        current_date_obj = arrow.get(current_date)
-        parsed_objects.append(
-            parse_daily_activity_summary(activity_obj, current_date_obj)
+        parsed_rows.append(
+            parse_daily_activity_summary(activity_obj, day_epoch(current_date))
         )
-        parsed_objects.extend(parse_activity_summaries(activity_obj["activities"]))
-        for activity in activity_obj["activities"]:
-            parsed_objects.extend(
-                parse_activity_details(activity["logId"], folder_path)
-            )
-    return parsed_objects
+        parsed_rows.extend(parse_activity_summaries(activity_obj["activities"]))
+    yield from batches_from_rows(parsed_rows)
+    track_rows = []
+    for activity in activity_obj["activities"]:
+        track_builder = TrackBuilder(str(activity["logId"]))
+        # Long activities are split in to several batches while the TCX file is
+        # streamed.
+        yield from iter_batches(
+            Activity.__table__,
+            track_builder.add_rows(
+                iter_activity_details(activity["logId"], folder_path)
+            ),
+        )
+        track_row = track_builder.get_row()
+        if track_row is not None:
+            track_rows.append(track_row)
+    if len(track_rows) > 0:
+        yield ColumnBatch.from_rows(ActivityTrack.__table__, track_rows)
 
 
-def get_archived_files(folder_path):
-    if isdir(folder_path):
-        return [f for f in listdir(folder_path) if isfile(join(folder_path, f))]
-    else:
-        return None
+MINUTES_PER_DAY = 1440
 
 
-def get_activity_log_file_names(date_string_folder_path):
-    activity_filename = join(date_string_folder_path, "activities.json")
-    with open(activity_filename) as activity_file_handler:
-        activity_obj = json.load(activity_file_handler)
-        activities_list = activity_obj["activities"]
-        activity_logIds = [activity["logId"] for activity in activities_list]
-    return [(str(activity_logId) + ".xml") for activity_logId in activity_logIds]
+def parse_intraday_activity_columns(folder_path):
+    # One batch with a row per minute and a column per intraday resource, built column
+    # by column.
+    # Resources that aren't downloaded yet are left null, the day is loaded again once
+    # they are in.
+    date_epoch = day_epoch(basename(folder_path))
+    resource_values = []
+    for resource in INTRADAY_RESOURCES:
+        values = [None] * MINUTES_PER_DAY
+        file_path = join(folder_path, get_intraday_file_name(resource))
+        try:
+            with open_archived_file(file_path) as intra_day_file_handler:
+                intra_day_obj = json.load(intra_day_file_handler)
+        except FileNotFoundError:
+            resource_values.append(values)
+            continue
+        for series_obj in intra_day_obj[f"activities-{resource}-intraday"]["dataset"]:
+            time = series_obj["time"]  # HH:mm:ss
+            values[int(time[0:2]) * 60 + int(time[3:5])] = series_obj["value"]
+        if resource == "distance":
+            # Metres like the rest of the tables, fitbit reports kilometres.
+            values = [value * 1000 if value is not None else None for value in values]
+        resource_values.append(values)
+    minutes = [
+        minute
+        for minute in range(MINUTES_PER_DAY)
+        if any(values[minute] is not None for values in resource_values)
+    ]
+    if len(minutes) == 0:
+        return
+    time_stamps = array("q", (date_epoch + minute * 60 for minute in minutes))
+    yield ColumnBatch(
+        ActivityIntraday.__tablename__,
+        [time_stamps]
+        + [[values[minute] for minute in minutes] for values in resource_values],
+    )
+
+
+TIME_SERIES_MODELS = [
+    HeartRate,
+    HeartRateSummary,
+    SleepSummary,
+    SleepStagesInfo,
+    SleepClassicInfo,
+    SleepSegment,
+    DailyActivitySummary,
+    ActivitySummary,
+    Activity,
+    ActivityIntraday,
+]
+
+# --only, the tables each data type is loaded in to.
+DATA_TYPE_MODELS = {
+    "heart": [HeartRate, HeartRateSummary],
+    "sleep": [SleepClassicInfo, SleepStagesInfo, SleepSegment, SleepSummary],
+    "activity": [Activity, ActivityTrack, ActivitySummary, DailyActivitySummary],
+    "intraday": [ActivityIntraday],
+}
+# Days before its folder's date that the rows of a data type can start, sleep logged on
+# a day starts the evening before.
+DATA_TYPE_LOOKBACK_DAYS = {"heart": 0, "sleep": 1, "activity": 0, "intraday": 0}
+# Intraday series were added later, days are loaded without the files that aren't
+# downloaded yet.
+# They count as a change of the day's intraday data once they are, and only that is
+# loaded again.
+OPTIONAL_DATA_TYPES = {"intraday"}
+
+
+def filter_data_types(files, data_types):
+    return {
+        file_name: entry
+        for file_name, entry in files.items()
+        if get_data_type(file_name) in data_types
+    }
+
+
+def get_changed_data_types(folder, recorded_files, manifest, data_types=DATA_TYPES):
+    # Data types whose files were added, removed or downloaded again since the folder
+    # was loaded.
+    # Only those are loaded again, intraday files backfilled for old days don't reload
+    # their heart rate.
+    files = manifest.get_files(folder)
+    changed_data_types = set()
+    for data_type in data_types:
+        data_type_files = filter_data_types(files, [data_type])
+        recorded_data_type_files = filter_data_types(recorded_files, [data_type])
+        if data_type_files.keys() != recorded_data_type_files.keys() or any(
+            entry["sha1"] != recorded_data_type_files[file_name].checksum
+            for file_name, entry in data_type_files.items()
+        ):
+            changed_data_types.add(data_type)
+    return changed_data_types
 
 
-def does_folder_contain_all_the_data(folder_path):
-    folder_listing = get_archived_files(folder_path)
+def get_ingest_state(session, user_id):
+    ingest_state = {}
+    for ingested_file in session.query(IngestedFile).filter(
+        IngestedFile.user_id == user_id
+    ):
+        ingest_state.setdefault(ingested_file.folder, {})[
+            ingested_file.file_name
+        ] = ingested_file
+    return ingest_state
 
-    remaining_files = [
-        file for file in ARCHIVAL_FILE_LISTING if (file not in folder_listing)
+
+def record_ingested_folder(
+    session, user_id, folder_path, manifest, data_types=DATA_TYPES
+):
+    # Only the files of the data types that were loaded, with --only the others are
+    # still to be done.
+    folder = basename(folder_path)
+    loaded_at = arrow.utcnow().datetime
+    files = filter_data_types(manifest.get_files(folder), data_types)
+    recorded_file_names = [
+        file_name
+        for (file_name,) in session.query(IngestedFile.file_name).filter(
+            IngestedFile.user_id == user_id, IngestedFile.folder == folder
+        )
+        if get_data_type(file_name) in data_types
     ]
+    session.query(IngestedFile).filter(
+        IngestedFile.user_id == user_id,
+        IngestedFile.folder == folder,
+        IngestedFile.file_name.in_(recorded_file_names),
+    ).delete(synchronize_session=False)
+    session.add_all(
+        [
+            IngestedFile(
+                user_id=user_id,
+                folder=folder,
+                file_name=file_name,
+                size=entry["size"],
+                checksum=entry["sha1"],
+                loaded_at=loaded_at,
+            )
+            for file_name, entry in files.items()
+        ]
+    )
+
+
+def count_ingested_folder(user_id, folder_path, manifest, data_types=DATA_TYPES):
+    # Once the folder's transaction is committed, a retried transaction isn't counted
+    # twice.
+    files = filter_data_types(manifest.get_files(basename(folder_path)), data_types)
+    metrics.increment("folders", user=user_id)
+    for file_name, entry in files.items():
+        metrics.increment(
+            "bytes_parsed", entry["size"], file_type=get_file_type(file_name)
+        )
+
+
+def get_folders_that_need_processing(
+    start_timestamp,
+    ingest_state,
+    manifest,
+    data_types=DATA_TYPES,
+    from_date=None,
+    to_date=None,
+    force=False,
+):
+    # Decided from the manifest and the ingest state alone, the archive folder is not
+    # listed.
+    # Folder path -> the data types to load from it.
+    folder_data_types = {}
+    for folder in manifest.folders:
+        if not is_in_date_range(folder, from_date, to_date):
+            continue
+        date_for_folder_name = arrow.get(folder)
+        # Days before config.json's start_date are only loaded when --from asks for them.
+        if from_date is None and date_for_folder_name < start_timestamp:
+            continue
+        recorded_files = ingest_state.get(folder)
+        # --force loads every day in the range again, loaded or not.
+        if force or recorded_files is None:
+            changed_data_types = set(data_types)
+        else:
+            changed_data_types = get_changed_data_types(
+                folder, recorded_files, manifest, data_types
+            )
+        if len(changed_data_types) > 0:
+            folder_data_types[join(manifest.archive_folder, folder)] = (
+                changed_data_types
+            )
+    return folder_data_types
+
+
+def seed_ingest_state(session, user):
+    # One time migration for databases loaded before ingested_file existed, the day
+    # folders before the user's earliest watermark are recorded as loaded. From then on
+    # only the ingest state is used, a database that is empty when ingested_file is
+    # created has nothing to seed.
+    watermark = get_earliest_time_stamp(session, user["user_id"])
+    if watermark is None:
+        return 0
+    manifest = Manifest(user["archive_folder"])
+    folders = [folder for folder in manifest.folders if arrow.get(folder) < watermark]
+    for folder in folders:
+        record_ingested_folder(
+            session, user["user_id"], join(manifest.archive_folder, folder), manifest
+        )
+    return len(folders)
+
+
+def get_watermarks(session, user_id):
+    return {
+        model.__tablename__: session.query(func.max(model.time_stamp))
+        .filter(model.user_id == user_id)
+        .one()[0]
+        for model in TIME_SERIES_MODELS
+    }
 
-    if len(remaining_files) != 0:
-        return False
 
-    tcx_log_file_names = get_activity_log_file_names(folder_path)
-    remaining_tcx_log_files = [
-        tcx_file for tcx_file in tcx_log_file_names if (tcx_file not in folder_listing)
+def get_earliest_time_stamp(session, user_id):
+    # Tables which never got any data (no activities recorded, ...) don't hold back the
+    # watermark.
+    recorded_time_stamps = [
+        time_stamp
+        for time_stamp in get_watermarks(session, user_id).values()
+        if time_stamp is not None
     ]
-    if len(remaining_tcx_log_files) != 0:
-        return False
+    if len(recorded_time_stamps) == 0:
+        return None
+    # Last day is reprocessed as it might have been loaded partially.
+    return arrow.get(min(recorded_time_stamps)).floor("day")
+
+
+# Bump when the parsers' output changes, cached output of older parsers isn't used.
+PARSER_VERSION = 3
+
+
+def get_parse_cache_keys(folder, manifest, sleep_storage):
+    # Parsed output only depends on the source files, the day, the parser version and
+    # --sleep-storage.
+    # The day is part of the key, parsers take time stamps from the folder name (the
+    # daily activity summary) and two days can have the same files, e.g. days the
+    # tracker wasn't worn.
+    files = manifest.get_files(folder)
+    return {
+        data_type: get_cache_key(
+            PARSER_VERSION,
+            folder,
+            data_type,
+            sleep_storage if data_type == "sleep" else None,
+            sorted(
+                (file_name, entry["sha1"])
+                for file_name, entry in files.items()
+                if get_data_type(file_name) == data_type
+            ),
+        )
+        for data_type in DATA_TYPES
+    }
+
+
+def parse_data_type(folder_path, data_type, sleep_storage):
+    if data_type == "heart":
+        return parse_heart_rate_columns(folder_path)
+    if data_type == "sleep":
+        return parse_sleep_zone_info(folder_path, sleep_storage)
+    if data_type == "intraday":
+        return parse_intraday_activity_columns(folder_path)
+    # activities.json and the day's tcx files.
+    return parse_activity_info(folder_path)
+
+
+def iter_folder_batches(
+    folder_path,
+    sleep_storage="points",
+    parse_metrics=metrics,
+    data_types=DATA_TYPES,
+    cache_keys=None,
+):
+    for data_type in DATA_TYPES:
+        if data_type not in data_types:
+            continue
+        cache_key = None
+        if parse_cache is not None and cache_keys is not None:
+            cache_key = cache_keys[data_type]
+            batches = parse_cache.load(cache_key)
+            if batches is not None:
+                parse_metrics.increment("parse_cache_hits", data_type=data_type)
+                yield from batches
+                continue
+            parse_metrics.increment("parse_cache_misses", data_type=data_type)
+        parsed_batches = parse_metrics.timed(
+            "parse",
+            parse_data_type(folder_path, data_type, sleep_storage),
+            data_type=data_type,
+        )
+        if cache_key is None:
+            yield from parsed_batches
+        else:
+            # A day's batches of one data type are held in memory while they are cached.
+            batches = list(parsed_batches)
+            parse_cache.store(cache_key, batches)
+            yield from batches
+
+
+def parse_folder(
+    folder_path, cache_keys=None, data_types=DATA_TYPES, sleep_storage="points"
+):
+    # Runs in parser processes when --workers > 1, only plain column batches and parse
+    # timers are sent back.
+    folder_metrics = Metrics(metrics.prefix)
+    batches = list(
+        iter_folder_batches(
+            folder_path, sleep_storage, folder_metrics, data_types, cache_keys
+        )
+    )
+    return folder_path, batches, folder_metrics.snapshot()
+
+
+def iter_parsed_batches(
+    folder_list, sleep_storage, workers, data_type_list=None, manifests=None
+):
+    # Yields (folder, batch) as the folders are parsed and (folder, None) once a folder
+    # is complete.
+    # data_type_list holds the data types to parse of each folder, every data type
+    # without it.
+    # manifests holds the manifest of each folder's archive, without them the parse
+    # cache isn't used.
+    if data_type_list is None:
+        data_type_list = [DATA_TYPES] * len(folder_list)
+    if manifests is not None:
+        cache_key_list = [
+            get_parse_cache_keys(basename(folder_path), manifest, sleep_storage)
+            for folder_path, manifest in zip(folder_list, manifests)
+        ]
+    else:
+        cache_key_list = [None] * len(folder_list)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parse = partial(parse_folder, sleep_storage=sleep_storage)
+            # Parsed folders wait in the pool only while the writer keeps up.
+            for folder_path, batches, folder_metrics in bounded_map(
+                executor,
+                parse,
+                folder_list,
+                cache_key_list,
+                data_type_list,
+                window=workers * 2,
+            ):
+                metrics.merge(folder_metrics)
+                yield from ((folder_path, batch) for batch in batches)
+                yield folder_path, None
+    else:
+        for folder_path, cache_keys, data_types in zip(
+            folder_list, cache_key_list, data_type_list
+        ):
+            for batch in iter_folder_batches(
+                folder_path, sleep_storage, metrics, data_types, cache_keys
+            ):
+                yield folder_path, batch
+            yield folder_path, None
+
+
+SECONDS_PER_DAY = 86400
+# chunk_time_interval of the hypertables, chunks start at multiples of it since the
+# epoch.
+CHUNK_DAYS = 7
 
-    return True
 
+def get_transaction_key(user_id, folder_path, transaction):
+    day = day_epoch(basename(folder_path)) // SECONDS_PER_DAY
+    if transaction == "chunk":
+        return user_id, day // CHUNK_DAYS
+    return user_id, day
 
-def get_folders_that_need_processing(earliest_time_stamp):
-    folder_list = []
-    for file in listdir(fitbit_data_archival_folder):
-        file_path = join(fitbit_data_archival_folder, file)
-        if isdir(file_path):
-            date_for_folder_name = arrow.get(file)
-            if date_for_folder_name < earliest_time_stamp:
-                pass
+
+class Transaction:
+    # Parsed batches and completed day folders of one transaction key, loaded and
+    # committed by one writer.
+    # Transactions hold different days or users, writers load them side by side without
+    # touching the same rows.
+    def __init__(self, key):
+        self.key = key
+        self.batches = []
+        # (user_id, folder_path, manifest, data_types) of the folders whose batches are
+        # all in this transaction.
+        self.folders = []
+
+
+def iter_transactions(parsed_batches, folder_users, transaction):
+    # Folders are sorted, so every chunk (or day) of a user is a single transaction.
+    current_transaction = None
+    for each_folder, batch in parsed_batches:
+        user_id, manifest, data_types = folder_users[each_folder]
+        transaction_key = get_transaction_key(user_id, each_folder, transaction)
+        if current_transaction is None or transaction_key != current_transaction.key:
+            if current_transaction is not None:
+                yield current_transaction
+            current_transaction = Transaction(transaction_key)
+        if batch is None:
+            current_transaction.folders.append(
+                (user_id, each_folder, manifest, data_types)
+            )
+            continue
+        batch.user_id = user_id
+        metrics.increment("rows_parsed", len(batch), table=batch.table_name)
+        current_transaction.batches.append(batch)
+    if current_transaction is not None:
+        yield current_transaction
+
+
+def record_loaded_days(loaded_days, batches):
+    for batch in batches:
+        if len(batch) == 0:
+            continue
+        start, end = batch.get_time_range()
+        loaded_days.setdefault(batch.table_name, set()).update(
+            range(int(start // SECONDS_PER_DAY), int(end // SECONDS_PER_DAY) + 1)
+        )
+
+
+def get_refresh_windows(loaded_days):
+    # Consecutive days are refreshed as one window, a nightly run ends up with a single
+    # day per table.
+    windows = {}
+    for table_name, days in loaded_days.items():
+        day_ranges = []
+        for day in sorted(days):
+            if len(day_ranges) > 0 and day_ranges[-1][1] == day - 1:
+                day_ranges[-1][1] = day
             else:
-                folder_list.append(file_path)
-    return folder_list
+                day_ranges.append([day, day])
+        windows[table_name] = [
+            (
+                arrow.get(first_day * SECONDS_PER_DAY).naive,
+                arrow.get((last_day + 1) * SECONDS_PER_DAY - 1).naive,
+            )
+            for first_day, last_day in day_ranges
+        ]
+    return windows
 
 
-def get_earliest_time_stamp(session):
-    last_recorded_heart_rate_timestamp = (
-        session.query(func.max(HeartRate.time_stamp)).one()[0] or start_timestamp
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Parses the downloaded fitbit archive and stores it in timescale-db"
+    )
+    parser.add_argument(
+        "--loader",
+        choices=sorted(LOADERS),
+        default="copy",
+        help="copy streams rows through postgres COPY, orm uses session.add_all",
     )
-    last_recorded_heart_rate_summary_timestamp = (
-        session.query(func.max(HeartRateSummary.time_stamp)).one()[0] or start_timestamp
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes parsing day folders, the database is written from a single process",
     )
-    return min([last_recorded_heart_rate_timestamp, last_recorded_heart_rate_timestamp])
+    parser.add_argument(
+        "--sleep-storage",
+        choices=SLEEP_STORAGE_MODES,
+        default="points",
+        help="segments stores sleep levels as intervals in sleep_segment, expanded by the *_expanded views",
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="create missing tables and apply hypertable, compression and retention settings, without loading data",
+    )
+    parser.add_argument(
+        "--on-conflict",
+        choices=["update", "nothing"],
+        default="update",
+        help="what the copy loader does with rows that are already in the database",
+    )
+    parser.add_argument(
+        "--transaction",
+        choices=["chunk", "day"],
+        default="chunk",
+        help="commit after every hypertable chunk (week) or every day folder, a failure only loses the transaction in flight",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=16,
+        help="parsed batches waiting for the database writer, parsing pauses when the queue is full",
+    )
+    parser.add_argument(
+        "--writers",
+        type=int,
+        default=1,
+        help="transactions (chunks or days) loaded at the same time, each over a connection of its own",
+    )
+    parser.add_argument(
+        "--load-retries",
+        type=int,
+        default=3,
+        help="times a transaction is loaded again after a connection error or a deadlock",
+    )
+    parser.add_argument(
+        "--echo-sql", action="store_true", help="log every SQL statement"
+    )
+    add_selection_arguments(parser)
+    add_metrics_arguments(parser)
+    return parser.parse_args(argv)
+
 
+def delete_days(session, user_id, data_types, from_date, to_date, loaded_days):
+    # --force, rows of the selected data types from the start of from_date to the end of
+    # to_date are deleted before the days are loaded again. Committed before the writers
+    # start, they load on connections of their own.
+    start_day = day_epoch(from_date) // SECONDS_PER_DAY
+    end_day = day_epoch(to_date) // SECONDS_PER_DAY + 1
+    start = arrow.get(start_day * SECONDS_PER_DAY).naive
+    end = arrow.get(end_day * SECONDS_PER_DAY).naive
+    connection = session.connection()
+    for data_type in sorted(data_types):
+        for model in DATA_TYPE_MODELS[data_type]:
+            row_count = delete_time_range(
+                connection, model.__table__, start, end, user_id
+            )
+            print(
+                f"Deleted {row_count} rows of {user_id} from {model.__tablename__} ({from_date} to {to_date})"
+            )
+            # Continuous aggregates of the days that aren't loaded again are refreshed
+            # too.
+            loaded_days.setdefault(model.__tablename__, set()).update(
+                range(start_day, end_day)
+            )
 
-def main():
+
+def load_transaction(transaction, load_batches, retries=3):
+    # Runs in a writer thread with a session (and connection) of its own. Rows are
+    # upserted, so a transaction that failed on a dropped connection or a deadlock with
+    # another writer is rolled back and loaded again.
+    for attempt in range(retries + 1):
+        load_stats = LoadStats()
+        try:
+            with sessionmaker(bind=engine)() as session:
+                load_batches(session, transaction.batches, load_stats)
+                for user_id, folder_path, manifest, data_types in transaction.folders:
+                    record_ingested_folder(
+                        session, user_id, folder_path, manifest, data_types
+                    )
+                with metrics.time("commit"):
+                    session.commit()
+        except (OperationalError, InterfaceError) as exception:
+            if attempt == retries:
+                raise
+            print(f"Loading {transaction.key} failed with {exception.orig}, retrying")
+            metrics.increment("load_retries")
+            sleep(2**attempt)
+            continue
+        loaded_days = {}
+        record_loaded_days(loaded_days, transaction.batches)
+        return transaction, load_stats, loaded_days
+
+
+def commit_transaction(session, loaded_days):
+    with metrics.time("commit"):
+        session.commit()
+    with metrics.time("refresh_continuous_aggregates"):
+        refresh_continuous_aggregates(engine, get_refresh_windows(loaded_days))
+    loaded_days.clear()
+
+
+def get_user_folders(session, user, arguments):
+    # A user's day folders that need loading and the data types to load from each of
+    # them.
+    ingest_state = get_ingest_state(session, user["user_id"])
+    manifest = Manifest(user["archive_folder"])
+    to_date = arguments.to_date
+    if arguments.force and to_date is not None:
+        # Rows deleted from the last day can belong to the folders after it, they are
+        # loaded as well.
+        lookback_days = max(
+            DATA_TYPE_LOOKBACK_DAYS[data_type] for data_type in arguments.only
+        )
+        to_date = arrow.get(to_date).shift(days=lookback_days).format("YYYY-MM-DD")
+    folder_data_types = get_folders_that_need_processing(
+        start_timestamp,
+        ingest_state,
+        manifest,
+        arguments.only,
+        arguments.from_date,
+        to_date,
+        arguments.force,
+    )
+    for each_folder, data_types in list(folder_data_types.items()):
+        # Every file of the day, tcx files included, has to be downloaded before it is
+        # parsed. Days downloaded in part (downloader.py --only) are left out and their
+        # ingest state isn't recorded, they are loaded once the rest is downloaded.
+        missing_files = [
+            file_name
+            for file_name in manifest.get_missing_files(basename(each_folder))
+            if get_data_type(file_name) in data_types
+            and get_data_type(file_name) not in OPTIONAL_DATA_TYPES
+        ]
+        if len(missing_files) > 0:
+            print(
+                f"Skipping {each_folder}, {len(missing_files)} files aren't downloaded yet: {', '.join(sorted(missing_files))}"
+            )
+            metrics.increment("incomplete_folders", user=user["user_id"])
+            del folder_data_types[each_folder]
+    print(
+        f"{len(folder_data_types)} day folders of {user['user_id']} are new or have changed"
+    )
+    return folder_data_types, manifest
+
+
+def main(arguments=None):
+    # daemon.py runs it with arguments of its own.
+    arguments = arguments or parse_arguments()
+    engine.echo = arguments.echo_sql
+    start_metrics(metrics, arguments)
+    load_batches = partial(LOADERS[arguments.loader], on_conflict=arguments.on_conflict)
+    load_stats = LoadStats(metrics)
+    loaded_days = {}
+    seed_ingest_state_needed = not inspect(engine).has_table(IngestedFile.__tablename__)
     Base.metadata.create_all(engine, checkfirst=True)
+    with engine.begin() as connection:
+        add_user_ids(connection)
+        apply_hypertables(connection, timescale_retention)
+    create_continuous_aggregates(engine)
+    if seed_ingest_state_needed:
+        with sessionmaker(bind=engine)() as session:
+            for user in users:
+                seeded_folders = seed_ingest_state(session, user)
+                print(
+                    f"{seeded_folders} day folders of {user['user_id']} were loaded before"
+                )
+            session.commit()
+    if arguments.migrate:
+        return
     with sessionmaker(bind=engine)() as session:
-        earliest_time_stamp = get_earliest_time_stamp(session)
-        folder_list = get_folders_that_need_processing(start_timestamp)
-        sorted_folder_list = sorted(folder_list, reverse=True)
-        for each_folder in sorted_folder_list:
-            assert does_folder_contain_all_the_data(each_folder) == True
-            parsed_heart_rate_objects = parse_heart_rate_data(each_folder)
-            session.add_all(parsed_heart_rate_objects)
-            parsed_sleep_objects = parse_sleep_zone_info(each_folder)
-            session.add_all(parsed_sleep_objects)
-            parsed_activity_objects = parse_activity_info(each_folder)
-            session.add_all(parsed_activity_objects)
-        session.commit()
+        # Day folders of every user are parsed by the same --workers and loaded by the
+        # same --writers.
+        folder_list = []
+        # Folder path -> (user_id, manifest, data types to load), every user has an
+        # archive folder of their own.
+        folder_users = {}
+        for user in select_users(users, arguments.user_ids):
+            folder_data_types, manifest = get_user_folders(session, user, arguments)
+            user_folder_list = sorted(folder_data_types, reverse=True)
+            if arguments.force and len(user_folder_list) > 0:
+                delete_days(
+                    session,
+                    user["user_id"],
+                    arguments.only,
+                    arguments.from_date or basename(user_folder_list[-1]),
+                    arguments.to_date or basename(user_folder_list[0]),
+                    loaded_days,
+                )
+            folder_list.extend(user_folder_list)
+            for folder_path in user_folder_list:
+                folder_users[folder_path] = (
+                    user["user_id"],
+                    manifest,
+                    folder_data_types[folder_path],
+                )
+        if len(loaded_days) > 0:
+            # Deleted before any writer starts, the days are empty until they are loaded
+            # again.
+            commit_transaction(session, loaded_days)
+    parsed_batches = iter_in_background(
+        iter_parsed_batches(
+            folder_list,
+            arguments.sleep_storage,
+            arguments.workers,
+            [folder_users[folder_path][2] for folder_path in folder_list],
+            [folder_users[folder_path][1] for folder_path in folder_list],
+        ),
+        arguments.queue_size,
+    )
+    # Time the writers spend waiting on the parsers, close to zero when the database is
+    # the bottleneck.
+    transactions = iter_transactions(
+        metrics.timed("wait_for_parser", parsed_batches),
+        folder_users,
+        arguments.transaction,
+    )
+    load = partial(
+        load_transaction,
+        load_batches=load_batches,
+        retries=arguments.load_retries,
+    )
+    try:
+        with ThreadPoolExecutor(max_workers=arguments.writers) as executor:
+            # Committed transactions come back in order, the main thread keeps the stats
+            # and refreshes the aggregates.
+            for transaction, transaction_stats, transaction_days in bounded_map(
+                executor, load, transactions, window=arguments.writers
+            ):
+                load_stats.merge(transaction_stats)
+                for user_id, folder_path, manifest, data_types in transaction.folders:
+                    count_ingested_folder(user_id, folder_path, manifest, data_types)
+                with metrics.time("refresh_continuous_aggregates"):
+                    refresh_continuous_aggregates(
+                        engine, get_refresh_windows(transaction_days)
+                    )
+    finally:
+        # Stops the parser thread and its process pool when loading failed, daemon.py
+        # runs main again later.
+        parsed_batches.close()
+    load_stats.report(arguments.loader)
+    if parse_cache is not None:
+        evicted, cache_bytes = parse_cache.evict()
+        print(
+            f"Parse cache is {cache_bytes / 2 ** 30:.2f}GiB, {evicted} entries evicted"
+        )
+    finish_metrics(metrics, arguments)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()